@@ -0,0 +1,64 @@
+from typing import Dict, NamedTuple, Optional
+import lxml.html
+from lxml import etree
+
+CAPTCHA_IMAGE_ID = "c_status_ctl00_contentplaceholder1_defaultcaptcha_CaptchaImage"
+VALIDATION_SUMMARY_ID = "ctl00_ContentPlaceHolder1_ValidationSummary1"
+ERROR_ID = "ctl00_ContentPlaceHolder1_lblError"
+STATUS_VIEW_IDS = (
+    "ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblStatus",
+    "ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblCaseNo",
+    "ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblSubmitDate",
+    "ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblStatusDate",
+    "ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblMessage",
+)
+
+_WANTED_IDS = (CAPTCHA_IMAGE_ID, VALIDATION_SUMMARY_ID, ERROR_ID) + STATUS_VIEW_IDS
+_FIND = etree.XPath("//input[@type='hidden'] | //*[" + " or ".join("@id='%s'" % i for i in _WANTED_IDS) + "]")
+
+
+class StatusView(NamedTuple):
+    status: str
+    case_no: str
+    submit_date: str
+    status_date: str
+    message: str
+
+
+class CeacPage(NamedTuple):
+    hidden: Dict[str, str]
+    captcha_src: Optional[str]
+    # None when the page has no validation summary, i.e. the request was rejected
+    validation_summary: Optional[str]
+    error: Optional[str]
+    status: Optional[StatusView]
+
+
+EMPTY_PAGE = CeacPage({}, None, None, None, None)
+
+
+def parse_ceac_page(html: str) -> CeacPage:
+    """Pull the handful of elements the probe needs out of a CEAC status page."""
+    try:
+        doc = lxml.html.document_fromstring(html)
+    except (etree.ParserError, ValueError):
+        return EMPTY_PAGE
+    hidden = {}
+    by_id = {}
+    for el in _FIND(doc):
+        if el.tag == "input" and el.get("type") == "hidden":
+            hidden[el.get("name")] = el.get("value", "")
+        else:
+            by_id.setdefault(el.get("id"), el)
+
+    captcha = by_id.get(CAPTCHA_IMAGE_ID)
+    summary = by_id.get(VALIDATION_SUMMARY_ID)
+    error = by_id.get(ERROR_ID)
+    labels = [by_id.get(i) for i in STATUS_VIEW_IDS]
+    return CeacPage(
+        hidden=hidden,
+        captcha_src=captcha.get("src") if captcha is not None else None,
+        validation_summary=str(summary.text_content()).strip() if summary is not None else None,
+        error=str(error.text_content()) if error is not None else None,
+        status=StatusView(*(str(x.text_content()) for x in labels)) if all(x is not None for x in labels) else None,
+    )
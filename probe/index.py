@@ -1,13 +1,15 @@
-from typing import Dict, List
+from typing import Dict, List, NamedTuple, Tuple
 import requests
 import os
-from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 from pprint import pprint
 import logging
 import onnxruntime as ort
 import numpy as np
 from PIL import Image
+from ceac_html import CeacPage, parse_ceac_page
+import metrics
+from ratelimit import ROUTES, ROUTE_MIN_HEALTH, Route, RouteSession
 import string
 from io import BytesIO
 import logging
@@ -15,6 +17,9 @@ import json
 import base64
 import time
 import datetime
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 logger = logging.getLogger()
 
 characters = '-' + string.digits + string.ascii_uppercase
@@ -30,51 +35,211 @@ def decode(sequence):
     return s
 
 captcha_onnx = os.path.join(os.path.dirname(os.path.realpath(__file__)), "captcha.onnx")
-ORT_SESS = ort.InferenceSession(captcha_onnx, providers=['CPUExecutionProvider'])
+
+ORT_INTRA_THREADS = int(os.environ.get("ORT_INTRA_THREADS") or 0) # 0 = let onnxruntime decide
+ORT_INTER_THREADS = int(os.environ.get("ORT_INTER_THREADS") or 0)
+CAPTCHA_MAX_BATCH = int(os.environ.get("CAPTCHA_MAX_BATCH") or 64)
+
+def make_ort_session(intra_threads=ORT_INTRA_THREADS, inter_threads=ORT_INTER_THREADS):
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = intra_threads
+    opts.inter_op_num_threads = inter_threads
+    return ort.InferenceSession(captcha_onnx, sess_options=opts, providers=['CPUExecutionProvider'])
+
+ORT_SESS = make_ort_session()
+
+# Input buffer reused by every batch, guarded since the session is shared between threads
+_input_buf = np.zeros((CAPTCHA_MAX_BATCH, 3, height, width), dtype=np.float32)
+_input_lock = threading.Lock()
+_char_table = np.frombuffer(characters.encode(), dtype=np.uint8)
+
+class CaptchaGuess(NamedTuple):
+    text: str
+    char_conf: Tuple[float, ...] # probability of the step that emits each character
+    conf: float # product of char_conf, 0 when the length is not n_len
+
+def _keep_mask(t):
+    """Steps of an (N, T) array of class indices that `decode` emits."""
+    keep = np.zeros(t.shape, dtype=bool)
+    keep[:, :-1] = (t[:, :-1] != 0) & (t[:, :-1] != t[:, 1:])
+    # `decode` appends the last step only when something was kept before it
+    # and it differs from the last kept character
+    has_any = keep.any(axis=1)
+    last_idx = t.shape[1] - 2 - np.argmax(keep[:, -2::-1], axis=1)
+    last_kept = t[np.arange(t.shape[0]), last_idx]
+    keep[:, -1] = has_any & (t[:, -1] != 0) & (last_kept != t[:, -1])
+    return keep
+
+def decode_batch(t):
+    """Vectorized `decode` over an (N, T) array of class indices."""
+    keep = _keep_mask(t)
+    chars = _char_table[t]
+    return [chars[i][keep[i]].tobytes().decode() for i in range(t.shape[0])]
+
+def _run_batch(img_contents):
+    n = len(img_contents)
+    with _input_lock:
+        buf = _input_buf[:n]
+        for i, content in enumerate(img_contents):
+            img = np.asarray(Image.open(BytesIO(content)))
+            np.divide(np.transpose(img, (2, 0, 1)), np.float32(255.0), out=buf[i], dtype=np.float32)
+        x = ORT_SESS.run(None, {'input': buf})[0]
+    x = np.transpose(x, (1, 0, 2)) # (T, N, C) -> (N, T, C)
+    if not np.allclose(x.sum(-1), 1.0, atol=1e-3): # logits
+        x = np.exp(x - x.max(-1, keepdims=True))
+        x /= x.sum(-1, keepdims=True)
+    return np.argmax(x, -1), np.max(x, -1)
+
+def pred_batch(img_contents: List[bytes]) -> List[CaptchaGuess]:
+    """Solve a list of captcha PNGs with one `run` call per CAPTCHA_MAX_BATCH images."""
+    ret = []
+    for i in range(0, len(img_contents), CAPTCHA_MAX_BATCH):
+        t, p = _run_batch(img_contents[i:i + CAPTCHA_MAX_BATCH])
+        keep = _keep_mask(t)
+        for text, k, probs in zip(decode_batch(t), keep, p):
+            char_conf = tuple(probs[k].tolist())
+            conf = float(np.prod(char_conf)) if len(text) == n_len else 0.0
+            ret.append(CaptchaGuess(text, char_conf, conf))
+    return ret
 
 def pred(img_content):
-    img = np.asarray( Image.open(BytesIO(img_content)) ,dtype=np.float32) / 255.0
-    img = np.expand_dims(np.transpose(img,(2,0,1)), axis=0)
-    outputs = ORT_SESS.run(None, {'input': img})
-    x = outputs[0]
-    t = np.argmax( np.transpose(x,(1,0,2)), -1)
-    pred = decode(t[0])
-    return pred
+    return pred_batch([img_content])[0]
+
+def warmup():
+    # first run allocates the arena and picks kernels, keep it off the first query
+    with _input_lock:
+        ORT_SESS.run(None, {'input': _input_buf[:1]})
+        ORT_SESS.run(None, {'input': _input_buf})
+
+warmup()
+
+CAPTCHA_MIN_CONF = float(os.environ.get("CAPTCHA_MIN_CONF") or 0) # below it a new captcha is fetched instead of submitting
+CAPTCHA_MAX_REFETCH = int(os.environ.get("CAPTCHA_MAX_REFETCH") or 3)
+CONF_BUCKETS = 10
+
+class CaptchaStats:
+    """Confidence histogram of every solved captcha and how the submitted ones
+    fared, to pick the CAPTCHA_MIN_CONF with the lowest expected time per
+    accepted captcha."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.solved = np.zeros(CONF_BUCKETS, dtype=np.int64)
+        self.conf_sum = np.zeros(CONF_BUCKETS)
+        self.submitted = np.zeros(CONF_BUCKETS, dtype=np.int64)
+        self.correct = np.zeros(CONF_BUCKETS, dtype=np.int64)
+        self.fetch_time = None # EWMA seconds of page + captcha GET and inference
+        self.submit_time = None # EWMA seconds of the POST
+
+    @staticmethod
+    def _ewma(old, new):
+        return new if old is None else 0.9 * old + 0.1 * new
+
+    @staticmethod
+    def bucket(conf):
+        return min(int(conf * CONF_BUCKETS), CONF_BUCKETS - 1)
+
+    def record_solved(self, guess: CaptchaGuess, elapsed):
+        with self.lock:
+            b = self.bucket(guess.conf)
+            self.solved[b] += 1
+            self.conf_sum[b] += guess.conf
+            self.fetch_time = self._ewma(self.fetch_time, elapsed)
+
+    def record_result(self, guess: CaptchaGuess, ok, elapsed):
+        with self.lock:
+            b = self.bucket(guess.conf)
+            self.submitted[b] += 1
+            self.correct[b] += ok
+            self.submit_time = self._ewma(self.submit_time, elapsed)
+
+    def suggest_threshold(self):
+        """Bucket edge minimising (fetch + P(submit) * submit) / P(submit and correct).
+        Buckets without submissions are assumed to be calibrated."""
+        with self.lock:
+            if self.solved.sum() == 0 or self.fetch_time is None or self.submit_time is None:
+                return None
+            predicted = self.conf_sum / np.maximum(self.solved, 1)
+            accuracy = np.where(self.submitted > 0, self.correct / np.maximum(self.submitted, 1), predicted)
+            share = self.solved / self.solved.sum()
+            best, best_cost = None, None
+            for b in range(CONF_BUCKETS):
+                submit = share[b:].sum()
+                success = (share[b:] * accuracy[b:]).sum()
+                if success <= 0:
+                    continue
+                cost = (self.fetch_time + submit * self.submit_time) / success
+                if best_cost is None or cost < best_cost:
+                    best, best_cost = b / CONF_BUCKETS, cost
+            return best
+
+    def stats(self):
+        suggested = self.suggest_threshold()
+        with self.lock:
+            submitted = int(self.submitted.sum())
+            return {
+                "solved": int(self.solved.sum()),
+                "submitted": submitted,
+                "accuracy": int(self.correct.sum()) / submitted if submitted else None,
+                "predicted_accuracy": float(self.conf_sum.sum() / self.solved.sum()) if self.solved.sum() else None,
+                "by_conf": [[int(n), int(s), int(c)] for n, s, c in zip(self.solved, self.submitted, self.correct)],
+                "min_conf": CAPTCHA_MIN_CONF,
+                "suggested_min_conf": suggested,
+            }
+
+CAPTCHA_STATS = CaptchaStats()
 
 ERR_CAPTCHA = "The code entered does not match the code displayed on the page."
+ERR_REJECTED = "Request Rejected"
+GUESS_FIELD = "_captcha_guess" # kept in the post data for the outcome, never sent
 
-URL = "https://ceac.state.gov/CEACStatTracker/Status.aspx?App=NIV"
-
-s = requests.Session()
-s.headers["User-Agent"]="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-s.headers["Accept"] = "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7"
-s.headers["Accept-Encoding"] = "gzip, deflate, br, zstd"
-s.headers["Accept-Language"] = "en-US,en;q=0.9"
-s.headers["sec-ch-ua"]= '"Google Chrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"'
-s.headers["sec-ch-ua-mobile"] = "?0"
-s.headers["sec-ch-ua-platform"] = "Windows"
-s.headers["Sec-Fetch-Dest"] = "document"
-s.headers["Sec-Fetch-Mode"] = "navigate"
-s.headers["Sec-Fetch-Site"] = "none"
-s.headers["Sec-Fetch-User"] = "?1"
-s.headers["Upgrade-Insecure-Requests"] = "1"
-
-
-def read_hidden_input(soup: BeautifulSoup):
-    ret = {}
-    input_list = soup.find_all("input", attrs={ "type":"hidden"})
-    for x in input_list:
-        ret[x.attrs["name"]] = x.attrs["value"]
-    return ret
+URL = os.environ.get("CEAC_URL") or "https://ceac.state.gov/CEACStatTracker/Status.aspx?App=NIV"
+EGRESS_IP_URL = os.environ.get("EGRESS_IP_URL", "http://httpbin.org/anything") # empty to skip
+PROBE_PORT = int(os.environ.get("PROBE_PORT") or 9000)
+
+PROBE_SESSIONS = int(os.environ.get("PROBE_SESSIONS") or 10)
+PREFETCH_TTL = float(os.environ.get("PREFETCH_TTL") or 300) # seconds a solved captcha stays usable
 
-def get_post_data(soup=None):
-    if soup is None:
-        html = s.get(URL, timeout=10).text
-        soup = BeautifulSoup(html, features="html.parser")
-    data = read_hidden_input(soup)
-    CaptchaImageUrl = soup.find(id="c_status_ctl00_contentplaceholder1_defaultcaptcha_CaptchaImage").attrs["src"]
-    img_resp = s.get(urljoin(URL,CaptchaImageUrl), timeout=10)
-    data["ctl00$ContentPlaceHolder1$Captcha"]=pred(img_resp.content)
+def new_session(route: Route=None):
+    s = requests.Session() if route is None else RouteSession(route)
+    s.headers["User-Agent"]="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
+    s.headers["Accept"] = "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7"
+    s.headers["Accept-Encoding"] = "gzip, deflate, br, zstd"
+    s.headers["Accept-Language"] = "en-US,en;q=0.9"
+    s.headers["sec-ch-ua"]= '"Google Chrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"'
+    s.headers["sec-ch-ua-mobile"] = "?0"
+    s.headers["sec-ch-ua-platform"] = "Windows"
+    s.headers["Sec-Fetch-Dest"] = "document"
+    s.headers["Sec-Fetch-Mode"] = "navigate"
+    s.headers["Sec-Fetch-Site"] = "none"
+    s.headers["Sec-Fetch-User"] = "?1"
+    s.headers["Upgrade-Insecure-Requests"] = "1"
+    return s
+
+s = new_session()
+
+
+def get_post_data(page: CeacPage=None, session=s):
+    # a captcha the model is unsure of is replaced by a fresh page, which is
+    # cheaper than a POST that comes back with ERR_CAPTCHA
+    for attempt in range(CAPTCHA_MAX_REFETCH + 1):
+        start = time.monotonic()
+        if page is None:
+            with metrics.STAGE_SECONDS.time(stage="page_get"):
+                html = session.get(URL, timeout=10).text
+            with metrics.STAGE_SECONDS.time(stage="parse"):
+                page = parse_ceac_page(html)
+        with metrics.STAGE_SECONDS.time(stage="captcha_get"):
+            img_resp = session.get(urljoin(URL,page.captcha_src), timeout=10)
+        with metrics.STAGE_SECONDS.time(stage="inference"):
+            guess = pred(img_resp.content)
+        CAPTCHA_STATS.record_solved(guess, time.monotonic() - start)
+        if (guess.conf > 0 and guess.conf >= CAPTCHA_MIN_CONF) or attempt == CAPTCHA_MAX_REFETCH:
+            break
+        metrics.CAPTCHA_REFETCHES.inc(reason="length" if guess.conf == 0 else "confidence")
+        page = None
+    data = dict(page.hidden)
+    data[GUESS_FIELD] = guess
+    data["ctl00$ContentPlaceHolder1$Captcha"]=guess.text
     data["ctl00_ToolkitScriptManager1_HiddenField"]=";;AjaxControlToolkit, Version=3.5.51116.0, Culture=neutral, PublicKeyToken=28f01b0e84b6d53e:en-US:2a06c7e2-728e-4b15-83d6-9b269fb7261e:de1feab2:f2c8e708:8613aea7:f9cec9bc:3202a5a2:a67c2700:720a52bf:589eaa30:ab09e3fe:87104b7c:be6fb298"
     data["ctl00$ContentPlaceHolder1$Visa_Application_Type"]="NIV"
     data["__EVENTTARGET"]="ctl00$ContentPlaceHolder1$btnSubmit"
@@ -84,86 +249,289 @@ def get_post_data(soup=None):
     data["__LASTFOCUS"]=""
     return data
 
-def query_ceac_state(loc, case_no, passport_number, surname, data=None):
+def query_ceac_state(loc, case_no, passport_number, surname, data=None, session=s):
     if data is None:
-        data = get_post_data()
+        data = get_post_data(session=session)
     data["ctl00$ContentPlaceHolder1$Location_Dropdown"]=loc
     data["ctl00$ContentPlaceHolder1$Visa_Case_Number"]=case_no
     data["ctl00$ContentPlaceHolder1$Passport_Number"] = passport_number
     data["ctl00$ContentPlaceHolder1$Surname"] = surname
+    guess = data.pop(GUESS_FIELD, None)
 
-    resp = s.post(URL,data, timeout=10)
-    soup = BeautifulSoup(resp.text, features="html.parser")
+    start = time.monotonic()
+    with metrics.STAGE_SECONDS.time(stage="post"):
+        resp = session.post(URL,data, timeout=10)
+    elapsed = time.monotonic() - start
+    with metrics.STAGE_SECONDS.time(stage="parse"):
+        page = parse_ceac_page(resp.text)
 
-    error_tag = soup.find(id="ctl00_ContentPlaceHolder1_ValidationSummary1")
-    if error_tag is None:
+    if page.validation_summary is None:
         # Request Rejected
         # Second captcha and just retry
-        return ERR_CAPTCHA, None
-
-    error_text = error_tag.text.strip()
-    if error_text:
-        return error_text, None
-
-    error_text = soup.find(id="ctl00_ContentPlaceHolder1_lblError").text
-    if error_text:
-        return error_text, None
-    status = soup.find(id="ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblStatus").text
-    caseno = soup.find(id="ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblCaseNo").text
-    SubmitDate = soup.find(id="ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblSubmitDate").text
-    StatusDate = soup.find(id="ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblStatusDate").text
-    Message = soup.find(id="ctl00_ContentPlaceHolder1_ucApplicationStatusView_lblMessage").text
+        metrics.REJECTED.inc()
+        return ERR_REJECTED, None
+
+    if guess is not None:
+        CAPTCHA_STATS.record_result(guess, page.validation_summary != ERR_CAPTCHA, elapsed)
+    if page.validation_summary == ERR_CAPTCHA:
+        metrics.CAPTCHA_FAILURES.inc()
+    if page.validation_summary:
+        return page.validation_summary, None
+
+    if page.error:
+        return page.error, None
+    status, caseno, SubmitDate, StatusDate, Message = page.status
     assert caseno == case_no    
-    return (status,SubmitDate,StatusDate,Message), soup
+    return (status,SubmitDate,StatusDate,Message), page
 
 
-def query_ceac_state_safe(loc, case_no, passport_number, surname, soup=None):
+def query_ceac_state_safe(loc, case_no, passport_number, surname, page=None, session=s, data=None):
     if case_no == "TEST":
         return (
                 "DEBUG_INFO_"+str(datetime.datetime.now()) ,
                 datetime.datetime.strftime(datetime.date(2024,1,1),"%d-%b-%Y"),
                 datetime.datetime.strftime(datetime.date.today(),"%d-%b-%Y"),
                 "DEBUG_%s_%s_%s_%s" %(loc,case_no,passport_number,surname)
-        ), soup
-    for _ in range(5):
+        ), page
+    route = getattr(session, "route", None)
+    for attempt in range(5):
+        if attempt:
+            metrics.RETRIES.inc()
         try:
-            data = get_post_data(soup)
-            result, soup = query_ceac_state(loc, case_no, passport_number, surname, data)
+            if data is None:
+                data = get_post_data(page, session)
+            result, page = query_ceac_state(loc, case_no, passport_number, surname, data, session)
+            data = None
             logger.info("Info!,%s-%s: %s",loc, case_no, result)
         except Exception as e:
             logger.error("Error!,%s-%s:",loc, case_no, exc_info=e, stack_info=True) 
+            metrics.EXCEPTIONS.inc(type=type(e).__name__)
+            if route is not None and isinstance(e, requests.RequestException):
+                route.reject()
             return str(e), None
-        if result != ERR_CAPTCHA:
+        # no sleep before retrying, the route's bucket paces the next request
+        if result == ERR_REJECTED:
+            if route is not None:
+                route.reject()
+        elif result != ERR_CAPTCHA:
+            if route is not None:
+                route.success()
             break
-        else:
-            time.sleep(1)
-    return result, soup
+    return result, page
+
+
+class ProbeSession:
+    """A CEAC browser session with its own cookies and the last result page,
+    whose hidden fields and captcha are reused by the next query."""
+    def __init__(self, route: Route):
+        self.route = route
+        self.session = new_session(route)
+        self.page = None
+        self.token = None
+        self.token_time = 0.0
+
+    def rebind(self, route: Route):
+        """Start over on another route, cookies and page are tied to the old one."""
+        self.__init__(route)
+
+    def prefetch(self):
+        """Solve the captcha of the current page ahead of the next query."""
+        try:
+            self.token = get_post_data(self.page, self.session)
+            self.token_time = time.monotonic()
+        except Exception as e:
+            logger.warning("Prefetch failed: %s", e)
+            self.token, self.page = None, None
+
+    def take_token(self):
+        token, self.token = self.token, None
+        if token is not None and time.monotonic() - self.token_time < PREFETCH_TTL:
+            return token
+        return None
+
+    def query(self, loc, case_no, passport_number, surname, data=None):
+        result, self.page = query_ceac_state_safe(loc, case_no, passport_number, surname, self.page, self.session, data)
+        return result
+
+
+class SessionPool:
+    """Sessions go back to `idle` only after the prefetcher has primed them with
+    a token, so a query usually starts straight at the final POST."""
+    def __init__(self, size=PROBE_SESSIONS):
+        self.idle = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="probe")
+        self.prefetcher = ThreadPoolExecutor(max_workers=size, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+        for _ in range(size):
+            self.release(ProbeSession(ROUTES.assign()))
+        threading.Thread(target=self._keep_fresh, name="prefetch-refresh", daemon=True).start()
+
+    def release(self, ps: ProbeSession):
+        if ps.route.health < ROUTE_MIN_HEALTH:
+            route = ROUTES.assign(ps.route)
+            if route is not ps.route:
+                logger.info("Moving a session from route %s to %s", ps.route.name, route.name)
+                ps.rebind(route)
+        self.prefetcher.submit(self._prefetch, ps)
+
+    def _prefetch(self, ps: ProbeSession):
+        try:
+            ps.prefetch()
+        finally:
+            self.idle.put(ps)
+
+    def _keep_fresh(self):
+        """Re-prime idle sessions whose token is near PREFETCH_TTL, so the pool
+        is still ready after a pause in traffic."""
+        while True:
+            time.sleep(PREFETCH_TTL / 4)
+            oldest = time.monotonic() - PREFETCH_TTL * 3 / 4
+            for _ in range(self.idle.qsize()):
+                try:
+                    ps = self.idle.get_nowait()
+                except queue.Empty:
+                    break
+                if ps.token is not None and ps.token_time > oldest:
+                    self.idle.put(ps)
+                else:
+                    ps.page = None # its server session may be as old as the token
+                    self.release(ps)
+
+    def query(self, loc, case_no, passport_number, surname):
+        start = time.perf_counter()
+        ps = self.idle.get()
+        try:
+            data = ps.take_token()
+            with self.lock:
+                if data is None:
+                    self.miss += 1
+                else:
+                    self.hit += 1
+            result = ps.query(loc, case_no, passport_number, surname, data)
+            metrics.RESULTS.inc(outcome="status" if isinstance(result, tuple) else "error")
+            return result
+        finally:
+            self.release(ps)
+            metrics.CASE_SECONDS.observe(time.perf_counter() - start)
+
+    def query_batch(self, req) -> Dict[str, object]:
+        futures = [(item[1], self.executor.submit(self.query, *item)) for item in req]
+        return {case_no: f.result() for case_no, f in futures}
+
+    def iter_batch(self, req):
+        """Yield (case_no, result) as soon as each case resolves."""
+        futures = {self.executor.submit(self.query, *item): item[1] for item in req}
+        for f in as_completed(futures):
+            yield futures[f], f.result()
+
+    def stats(self):
+        with self.lock:
+            total = self.hit + self.miss
+            return {"hit": self.hit, "miss": self.miss, "hit_rate": self.hit / total if total else 0.0}
+
+# started on first use, importing this module must not open sessions to CEAC
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> SessionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool()
+        return _pool
+
+metrics.Callback("probe_prefetch_total", "Queries that found a prefetched captcha (hit) or not (miss)",
+    lambda: {(("result", "hit"),): _pool.hit, (("result", "miss"),): _pool.miss} if _pool else {}, "counter")
+metrics.Callback("probe_idle_sessions", "Primed sessions waiting for a query", lambda: _pool.idle.qsize() if _pool else 0)
+metrics.Callback("probe_route_rate", "Requests per second allowed on each egress route",
+    lambda: {(("route", r.name),): r.rate for r in ROUTES.routes})
+metrics.Callback("probe_route_health", "Recent share of queries not rejected on each egress route",
+    lambda: {(("route", r.name),): r.health for r in ROUTES.routes})
+metrics.Callback("probe_route_wait_seconds_total", "Time requests waited for the rate limit on each egress route",
+    lambda: {(("route", r.name),): r.waited for r in ROUTES.routes}, "counter")
+
+def log_egress_ip():
+    if not EGRESS_IP_URL:
+        return
+    for route in ROUTES.routes:
+        try:
+            proxies = {"http": route.proxy, "https": route.proxy} if route.proxy else None
+            logger.info("my ip via %s is %s", route.name, s.get(EGRESS_IP_URL, proxies=proxies, timeout=5).text)
+        except Exception as e:
+            logger.warning("Cannot get my ip via %s: %s", route.name, e)
 
 
 def main_handler(req):
-    logger.info("my ip is %s", s.get("http://httpbin.org/anything").text)
-    ret = {}
-    soup = None
-    for loc, case_no, passport_number, surname in req:
-        result, soup = query_ceac_state_safe(loc, case_no, passport_number, surname, soup)
-        ret[case_no] = result
+    log_egress_ip()
+    pool = get_pool()
+    ret = pool.query_batch(req)
+    logger.info("Prefetch: %s", pool.stats())
+    logger.info("Routes: %s", ROUTES.stats())
+    logger.info("Captcha: %s", CAPTCHA_STATS.stats())
     return json.dumps(ret)
 
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+def stream_handler(req):
+    """Like main_handler, but yields one NDJSON line per case as it resolves."""
+    log_egress_ip()
+    pool = get_pool()
+    for case_no, result in pool.iter_batch(req):
+        yield json.dumps({"case_no": case_no, "result": result}) + "\n"
+    logger.info("Prefetch: %s", pool.stats())
+    logger.info("Routes: %s", ROUTES.stats())
+    logger.info("Captcha: %s", CAPTCHA_STATS.stats())
+
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MAX_REQUESTS = int(os.environ.get("PROBE_MAX_REQUESTS") or 4)
+# keep well below the web client's 30 s timeout: a request it has given up on
+# would still take a slot and query CEAC for nobody. It retries on the 503.
+REQUEST_WAIT = float(os.environ.get("PROBE_REQUEST_WAIT") or 5)
+request_slots = threading.BoundedSemaphore(MAX_REQUESTS)
 
 class RequestProxyHandler(BaseHTTPRequestHandler):
+    def wants_stream(self):
+        return "stream=1" in self.path or "application/x-ndjson" in (self.headers.get("Accept") or "")
+
     def do_POST(self):
         playload_raw = self.rfile.read(int(self.headers["Content-Length"]))
         event = json.loads(playload_raw)
-        ret = main_handler(event)
+        if not request_slots.acquire(timeout=REQUEST_WAIT):
+            self.send_response(503)
+            self.send_header("Retry-After", "10")
+            self.end_headers()
+            return
+        try:
+            if self.wants_stream():
+                self.send_response(200)
+                self.send_header("Content-type", "application/x-ndjson")
+                self.end_headers()
+                for line in stream_handler(event):
+                    self.wfile.write(line.encode())
+                    self.wfile.flush()
+                return
+            ret = main_handler(event).encode()
+        finally:
+            request_slots.release()
         self.send_response(200)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(ret)))
         self.end_headers()
-        self.wfile.write( ret.encode() )
+        self.wfile.write(ret)
         self.wfile.flush()
         
     def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
         self.send_response(200)
         self.send_header("Content-type", "text/html")
         self.end_headers()
@@ -171,11 +539,12 @@ class RequestProxyHandler(BaseHTTPRequestHandler):
         self.wfile.flush()
 
 
-def run(server_class=HTTPServer, handler_class=RequestProxyHandler):
-    server_address = ('', 9000)
+def run(server_class=ThreadingHTTPServer, handler_class=RequestProxyHandler):
+    server_address = ('', PROBE_PORT)
     httpd = server_class(server_address, handler_class)
+    get_pool() # prime sessions before the first request
     httpd.serve_forever()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    run()
\ No newline at end of file
+    run()
@@ -0,0 +1,130 @@
+"""In-process Prometheus metrics for the probe, rendered on GET /metrics.
+
+Only what the probe needs: counters and fixed-bucket histograms with labels,
+and values read from a callback at scrape time. Recording is a bisect and a
+few additions under a per-metric lock."""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY: List["Metric"] = []
+
+
+def _labels(labels: Dict[str, str], extra=None):
+    items = sorted(labels.items()) + (extra or [])
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def _value(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self) -> List[Tuple[str, dict, object]]:
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (name, _labels(labels), _value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(key), value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.values = {} # labels -> [count per bucket (last is +Inf), sum]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        ret = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                labels = dict(key)
+                cumulative = 0
+                for le, n in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += n
+                    ret.append((self.name + "_bucket", dict(labels, le="+Inf" if le == float("inf") else repr(le)), cumulative))
+                ret.append((self.name + "_sum", labels, total))
+                ret.append((self.name + "_count", labels, cumulative))
+        return ret
+
+
+class Callback(Metric):
+    """Values read at scrape time, `fn` returns {labels tuple: value} or a single value."""
+    def __init__(self, name, help, fn: Callable, kind="gauge"):
+        super().__init__(name, help)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, dict):
+            return [(self.name, dict(key), v) for key, v in value.items()]
+        return [(self.name, {}, value)]
+
+
+def render():
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+STAGE_SECONDS = Histogram("probe_stage_seconds", "Time spent in each step of a CEAC query")
+CASE_SECONDS = Histogram("probe_case_seconds", "Time to resolve one case, retries included", (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0))
+RETRIES = Counter("probe_retries_total", "Queries sent again after a captcha failure or rejection")
+CAPTCHA_FAILURES = Counter("probe_captcha_failures_total", "POSTs answered with a captcha mismatch")
+CAPTCHA_REFETCHES = Counter("probe_captcha_refetches_total", "Captchas replaced before submitting, by reason")
+REJECTED = Counter("probe_rejected_total", "POSTs answered without a validation summary (request rejected)")
+EXCEPTIONS = Counter("probe_exceptions_total", "Queries aborted by an exception, by type")
+RESULTS = Counter("probe_results_total", "Resolved cases by outcome")
+Callback("process_cpu_seconds_total", "User and system CPU time of the probe process", time.process_time, "counter")
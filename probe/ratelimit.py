@@ -0,0 +1,137 @@
+"""Per-route pacing of the requests sent to CEAC.
+
+A route is one way out: direct, or through one of the proxies in PROBE_PROXIES
+(comma separated, "direct" for no proxy). Every route paces its requests with
+a token bucket whose rate adapts AIMD style: each resolved query adds
+PROBE_RATE_INCREASE requests/s, each rejection or connection error multiplies
+the rate by PROBE_RATE_DECREASE and pauses the route for an exponential
+backoff. Rejections that arrive while the route is already backing off come
+from requests sent before it, and do not cut the rate again. Captcha
+mismatches are the model's fault and leave the rate alone.
+
+Routes also keep a health score, an average of recent outcomes that drifts
+back to 1 while the route is idle, and sessions move off routes whose health
+drops below ROUTE_MIN_HEALTH."""
+import os
+import threading
+import time
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import requests
+
+PROXIES = [p.strip() for p in (os.environ.get("PROBE_PROXIES") or "direct").split(",") if p.strip()]
+RATE = float(os.environ.get("PROBE_RATE") or 5) # starting requests/s per route
+RATE_MIN = float(os.environ.get("PROBE_RATE_MIN") or 0.2)
+RATE_MAX = float(os.environ.get("PROBE_RATE_MAX") or 30)
+RATE_INCREASE = float(os.environ.get("PROBE_RATE_INCREASE") or 0.5)
+RATE_DECREASE = float(os.environ.get("PROBE_RATE_DECREASE") or 0.5)
+BURST = float(os.environ.get("PROBE_BURST") or 5) # bucket size in requests
+BACKOFF = float(os.environ.get("PROBE_BACKOFF") or 1) # seconds, doubled per consecutive rejection
+BACKOFF_MAX = float(os.environ.get("PROBE_BACKOFF_MAX") or 60)
+HEALTH_ALPHA = 0.1
+HEALTH_HALF_LIFE = 600 # seconds for an idle route to recover half of its lost health
+ROUTE_MIN_HEALTH = float(os.environ.get("ROUTE_MIN_HEALTH") or 0.5)
+
+
+class Route:
+    def __init__(self, proxy: Optional[str], rate=RATE):
+        self.proxy = proxy
+        if proxy:
+            url = urlparse(proxy)
+            self.name = "%s:%s" % (url.hostname, url.port) if url.port else url.hostname # no credentials in labels
+        else:
+            self.name = "direct"
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = min(BURST, rate)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.strikes = 0 # consecutive rejections
+        self._health = 1.0
+        self.health_time = time.monotonic()
+        self.sessions = 0
+        self.waited = 0.0 # seconds spent waiting for tokens
+        self.requests = 0
+        self.rejected = 0
+
+    def acquire(self):
+        """Block until the route may send one request."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(BURST, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.requests += 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                self.waited += wait
+            time.sleep(wait)
+
+    @property
+    def health(self):
+        idle = time.monotonic() - self.health_time
+        return 1 - (1 - self._health) * 0.5 ** (idle / HEALTH_HALF_LIFE)
+
+    def _record(self, ok):
+        self._health = self.health * (1 - HEALTH_ALPHA) + HEALTH_ALPHA * ok
+        self.health_time = time.monotonic()
+
+    def success(self):
+        with self.lock:
+            self.rate = min(RATE_MAX, self.rate + RATE_INCREASE)
+            self.strikes = 0
+            self._record(1.0)
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+            self._record(0.0)
+            now = time.monotonic()
+            if now < self.paused_until:
+                return
+            self.rate = max(RATE_MIN, self.rate * RATE_DECREASE)
+            self.paused_until = now + min(BACKOFF_MAX, BACKOFF * 2 ** self.strikes)
+            self.strikes += 1
+
+    def stats(self):
+        with self.lock:
+            return {"rate": round(self.rate, 2), "health": round(self.health, 2), "sessions": self.sessions,
+                    "requests": self.requests, "rejected": self.rejected, "waited": round(self.waited, 1)}
+
+
+class RouteSession(requests.Session):
+    """A session bound to a route: proxied through it and paced by its bucket."""
+    def __init__(self, route: Route):
+        super().__init__()
+        self.route = route
+        if route.proxy:
+            self.proxies = {"http": route.proxy, "https": route.proxy}
+
+    def request(self, *args, **kwargs):
+        self.route.acquire()
+        return super().request(*args, **kwargs)
+
+
+class RoutePool:
+    def __init__(self, proxies: List[str] = PROXIES):
+        self.routes = [Route(None if p == "direct" else p) for p in proxies]
+        self.lock = threading.Lock()
+
+    def assign(self, current: Optional[Route] = None) -> Route:
+        """Route for a new session, or for one leaving `current`: the most
+        capacity (health times rate) per session."""
+        with self.lock:
+            if current is not None:
+                current.sessions -= 1
+            route = max(self.routes, key=lambda r: r.health * r.rate / (r.sessions + 1))
+            route.sessions += 1
+            return route
+
+    def stats(self):
+        return {r.name: r.stats() for r in self.routes}
+
+
+ROUTES = RoutePool()
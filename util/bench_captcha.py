@@ -0,0 +1,64 @@
+# Compare the batched captcha engine in probe/index.py against the original one-image `pred`,
+# and check the confidences it returns with each guess.
+# usage: python util/bench_captcha.py [repeat]
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "probe"))
+import index  # noqa: E402
+
+
+def legacy_pred(img_content):
+    # `pred` as it was before batching
+    img = np.asarray(Image.open(BytesIO(img_content)), dtype=np.float32) / 255.0
+    img = np.expand_dims(np.transpose(img, (2, 0, 1)), axis=0)
+    outputs = index.ORT_SESS.run(None, {'input': img})
+    x = outputs[0]
+    t = np.argmax(np.transpose(x, (1, 0, 2)), -1)
+    return index.decode(t[0])
+
+
+def random_captcha(rng):
+    buf = BytesIO()
+    arr = rng.integers(0, 256, (index.height, index.width, 3), dtype=np.uint8)
+    Image.fromarray(arr, "RGB").save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def check_decode(rng, n=20000, steps=12):
+    seqs = rng.integers(0, 4, (n, steps)) * rng.integers(0, index.n_classes, (n, 1)) % index.n_classes
+    assert index.decode_batch(seqs) == [index.decode(x) for x in seqs]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rng = np.random.default_rng(0)
+    check_decode(rng)
+    imgs = [random_captcha(rng) for _ in range(64)]
+    guesses = index.pred_batch(imgs)
+    assert [g.text for g in guesses] == [legacy_pred(x) for x in imgs]
+    assert all(len(g.char_conf) == len(g.text) and 0 <= g.conf <= 1 for g in guesses)
+    confs = np.array([g.conf for g in guesses])
+    print("confidence: %d/%d of length %d, quartiles %s" % (
+        (confs > 0).sum(), len(confs), index.n_len, np.round(np.percentile(confs, [25, 50, 75]), 3).tolist()))
+    print("%6s %14s %14s %8s" % ("batch", "legacy ms/img", "batch ms/img", "speedup"))
+    for n in (1, 2, 4, 8, 16, 32, 64):
+        batch = imgs[:n]
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            [legacy_pred(x) for x in batch]
+        t1 = time.perf_counter()
+        for _ in range(repeat):
+            index.pred_batch(batch)
+        t2 = time.perf_counter()
+        legacy, batched = (t1 - t0) / repeat / n * 1000, (t2 - t1) / repeat / n * 1000
+        print("%6d %14.3f %14.3f %7.2fx" % (n, legacy, batched, legacy / batched))
+
+
+if __name__ == "__main__":
+    main()
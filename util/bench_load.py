@@ -0,0 +1,62 @@
+# Concurrent GET load against a running web app, reporting req/s and latency per
+# concurrency level. Compare worker layouts by restarting the app between runs, e.g.
+#   DB_POOL_SIZE=5 gunicorn -w 4 --threads 8 -b 127.0.0.1:5000 web.app:app
+#   flask run --with-threads
+# usage: python util/bench_load.py BASE_URL [seconds] [path ...]
+#   python util/bench_load.py http://127.0.0.1:5000 10 /stat.js /detail/<case_id>
+import statistics
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BASE_URL = sys.argv[1].rstrip("/") if len(sys.argv) > 1 else "http://127.0.0.1:5000"
+DURATION = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+PATHS = sys.argv[3:] or ["/", "/stat.js"]
+CONCURRENCY = (1, 4, 16, 64)
+
+
+def run(concurrency):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + DURATION
+
+    def worker(n):
+        http = requests.Session()
+        http.mount("http://", HTTPAdapter(pool_maxsize=1))
+        i = n
+        while time.monotonic() < deadline:
+            url = BASE_URL + PATHS[i % len(PATHS)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                ok = http.get(url, timeout=30).status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    if not latencies:
+        print("%4d clients: no successful requests, %d errors" % (concurrency, errors[0]))
+        return
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print("%4d clients: %8.1f req/s   p50 %7.1f ms   p99 %7.1f ms   %d errors" % (
+        concurrency, len(latencies) / DURATION, statistics.median(latencies) * 1000, p99 * 1000, errors[0]))
+
+
+if __name__ == "__main__":
+    print("GET", ", ".join(PATHS), "on", BASE_URL)
+    for c in CONCURRENCY:
+        run(c)
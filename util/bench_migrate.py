@@ -0,0 +1,133 @@
+# Build a synthetic SQLite database with the pre-migration schema, time the hot
+# queries and show their plans, apply the migrations, then measure again.
+# usage: WX_CONFIG="a|b|c|d" python util/bench_migrate.py [db_path] [cases]
+import hashlib
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+DB_PATH = sys.argv[1] if len(sys.argv) > 1 else "/tmp/ceac_bench.sqlite"
+CASES = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+os.environ["DB_URL"] = "sqlite:///" + DB_PATH
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from sqlalchemy import Select, delete, event  # noqa: E402
+from web.app import Base, Case, Record, db, db_session, iter_due_chunks  # noqa: E402
+from web import migrations  # noqa: E402
+
+NEW_INDEXES = ("ix_record_case_id_status_date", "ix_case_sync", "ix_case_due")
+STATUSES = ["Refused", "Administrative Processing", "Issued", "Approved"]
+
+
+def populate(conn):
+    rng = random.Random(0)
+    now = datetime.now()
+    today = date.today()
+
+    def cases():
+        for i in range(CASES):
+            interview = today - timedelta(days=rng.randrange(365))
+            last_check = str(now - timedelta(hours=rng.randrange(48)))
+            yield (uuid.UUID(int=rng.getrandbits(128)).hex, "AA%08d" % i, rng.choice(["BEJ", "SHG", "GUZ", "SNY", "WHN"]),
+                   str(interview), last_check, last_check, rng.choice(STATUSES),
+                   # most old cases are issued (passport removed) or expired, as in production
+                   "E%08d" % i if rng.random() < 0.2 else None, "ZHANG",
+                   str(today + timedelta(days=rng.randrange(-120, 120))), str(interview),
+                   interview.isocalendar()[0] * 100 + interview.isocalendar()[1])
+
+    conn.executemany('INSERT INTO "case" (id, case_no, location, created_date, last_check, next_check_at, last_status, '
+                     'passport_number, surname, expire_date, interview_date, interview_week) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', cases())
+
+    texts = STATUSES + ["Your case is " + status for status in STATUSES] # status_text ids 1..8
+    conn.executemany("INSERT INTO status_text (id, text, digest) VALUES (?,?,?)",
+                     [(i + 1, t, hashlib.sha1(t.encode()).hexdigest()) for i, t in enumerate(texts)])
+
+    def records():
+        for (case_id, interview) in conn.execute('SELECT id, interview_date FROM "case"'):
+            day = date.fromisoformat(interview)
+            for i in range(rng.randrange(1, 4)):
+                day += timedelta(days=rng.randrange(1, 30))
+                yield case_id, str(day), i + 1, len(STATUSES) + i + 1
+
+    conn.executemany("INSERT INTO record (case_id, status_date, status_id, message_id) VALUES (?,?,?,?)", list(records()))
+    conn.commit()
+
+
+def reset(conn):
+    for name in NEW_INDEXES:
+        conn.execute("DROP INDEX IF EXISTS " + name)
+    conn.execute("DELETE FROM schema_version WHERE version >= 3")
+    conn.commit()
+    conn.execute("ANALYZE")
+
+
+captured = []
+event.listen(db, "before_cursor_execute", lambda conn, cursor, stmt, params, *a: captured.append((stmt, params)))
+
+
+def measure(name, fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        captured.clear()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    stmt, params = captured[0]
+    raw = sqlite3.connect(DB_PATH)
+    plan = [row[-1] for row in raw.execute("EXPLAIN QUERY PLAN " + stmt, params)]
+    raw.close()
+    print("  %-28s %9.2f ms   %s" % (name, statistics.median(times) * 1000, " | ".join(plan)))
+
+
+def run_queries():
+    rng = random.Random(1)
+    case_ids = [row[0] for row in db_session.execute(Select(Case.id).limit(1000))]
+    db_session.rollback()
+
+    def sync_scan():
+        for _ in iter_due_chunks(page_size=500):
+            pass
+
+    def record_list():
+        db_session.scalars(Select(Record).where(Record.case_id == rng.choice(case_ids))
+                           .order_by(Record.status_date.desc())).all()
+        db_session.rollback()
+
+    def cascade_delete():
+        db_session.execute(delete(Record).where(Record.case_id.in_(rng.sample(case_ids, 10))))
+        db_session.rollback()
+
+    measure("sync selection (all pages)", sync_scan, 3)
+    measure("record_list of one case", record_list, 50)
+    measure("delete records of 10 cases", cascade_delete, 20)
+
+
+def main():
+    fresh = not os.path.exists(DB_PATH)
+    if fresh:
+        Base.metadata.create_all(db)
+        migrations.upgrade(db, Base.metadata, target=2, log=lambda *a: None)
+    conn = sqlite3.connect(DB_PATH)
+    if fresh:
+        start = time.time()
+        populate(conn)
+        print("Populated %d cases in %.0fs" % (CASES, time.time() - start))
+    reset(conn)
+    print("Before migrations:")
+    run_queries()
+    start = time.time()
+    migrations.upgrade(db, Base.metadata)
+    print("Migrations applied in %.1fs" % (time.time() - start))
+    conn.execute("ANALYZE")
+    conn.commit()
+    print("After migrations:")
+    run_queries()
+
+
+if __name__ == "__main__":
+    main()
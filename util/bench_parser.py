@@ -0,0 +1,60 @@
+# Check probe/ceac_html.py against the BeautifulSoup code it replaced, over the
+# CEAC pages in util/fixtures (or the directory given), and time both.
+# usage: python util/bench_parser.py [fixture_dir] [repeat]
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+UTIL_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(UTIL_DIR, "..", "probe"))
+from ceac_html import CeacPage, StatusView, STATUS_VIEW_IDS, parse_ceac_page  # noqa: E402
+
+
+def legacy_parse(html):
+    # what read_hidden_input / get_post_data / query_ceac_state used to read
+    soup = BeautifulSoup(html, features="html.parser")
+    hidden = {x.attrs["name"]: x.attrs.get("value", "") for x in soup.find_all("input", attrs={"type": "hidden"})}
+    captcha = soup.find(id="c_status_ctl00_contentplaceholder1_defaultcaptcha_CaptchaImage")
+    summary = soup.find(id="ctl00_ContentPlaceHolder1_ValidationSummary1")
+    error = soup.find(id="ctl00_ContentPlaceHolder1_lblError")
+    labels = [soup.find(id=i) for i in STATUS_VIEW_IDS]
+    return CeacPage(
+        hidden=hidden,
+        captcha_src=captcha.attrs["src"] if captcha else None,
+        validation_summary=summary.text.strip() if summary else None,
+        error=error.text if error else None,
+        status=StatusView(*(x.text for x in labels)) if all(labels) else None,
+    )
+
+
+def main():
+    fixture_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(UTIL_DIR, "fixtures")
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    failed = 0
+    print("%-24s %12s %12s %8s" % ("fixture", "bs4 ms", "lxml ms", "speedup"))
+    for name in sorted(os.listdir(fixture_dir)):
+        if not name.endswith(".html"):
+            continue
+        html = open(os.path.join(fixture_dir, name), encoding="utf-8").read()
+        if legacy_parse(html) != parse_ceac_page(html):
+            failed += 1
+            print("%-24s MISMATCH" % name)
+            print("  bs4 :", legacy_parse(html))
+            print("  lxml:", parse_ceac_page(html))
+            continue
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            legacy_parse(html)
+        t1 = time.perf_counter()
+        for _ in range(repeat):
+            parse_ceac_page(html)
+        t2 = time.perf_counter()
+        legacy, fast = (t1 - t0) / repeat * 1000, (t2 - t1) / repeat * 1000
+        print("%-24s %12.3f %12.3f %7.1fx" % (name, legacy, fast, legacy / fast))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
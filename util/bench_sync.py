@@ -0,0 +1,151 @@
+# End-to-end sync throughput without touching ceac.state.gov: seed a SQLite database
+# with due cases, start util/ceac_standin.py and the probe against it, run `flask sync`
+# and report cases/min, per-case latency percentiles and probe CPU from /metrics.
+# usage: python util/bench_sync.py [cases] [db_path]
+# Sync and probe settings (PROBE_SESSIONS, PROBE_CONCURRENCY, SYNC_CHUNK_SIZE, ...)
+# and the stand-in's STANDIN_* knobs are read from the environment as usual.
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+import requests
+
+CASES = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+DB_PATH = sys.argv[2] if len(sys.argv) > 2 else "/tmp/ceac_bench_sync.sqlite"
+STANDIN_PORT = os.environ.setdefault("STANDIN_PORT", "8800")
+PROBE_PORT = os.environ.setdefault("PROBE_PORT", "9100")
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+
+os.environ.update(
+    DB_URL="sqlite:///" + DB_PATH,
+    WX_CONFIG=os.environ.get("WX_CONFIG") or "bench|bench|bench|bench",
+    CEAC_URL="http://127.0.0.1:%s/CEACStatTracker/Status.aspx?App=NIV" % STANDIN_PORT,
+    PROBE_URLS="http://127.0.0.1:%s" % PROBE_PORT,
+    EGRESS_IP_URL="",
+    PUSH_MSG="0",
+    FLASK_APP=os.path.join(ROOT, "web", "app.py"),
+)
+os.environ.pop("COS_URL", None)
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import Select, insert  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+from web.app import Base, Case, Record, SyncRun, db, db_session, status_texts  # noqa: E402
+from web import migrations  # noqa: E402
+
+
+def seed():
+    for path in (DB_PATH, DB_PATH + "-wal", DB_PATH + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    migrations.upgrade(db, Base.metadata)
+    rng = random.Random(0)
+    now = datetime.now()
+    today = date.today()
+    with Session(db) as session:
+        refused = status_texts.ids(session, ["Refused"])["Refused"]
+        session.commit()
+    cases, records = [], []
+    for i in range(CASES):
+        interview = today - timedelta(days=rng.randrange(120))
+        case_id = uuid.UUID(int=rng.getrandbits(128))
+        cases.append(dict(id=case_id, case_no="AA%08d" % i, location="BEJ", created_date=interview,
+            last_check=now - timedelta(days=1), next_check_at=now - timedelta(minutes=rng.randrange(600)),
+            last_status="Administrative Processing", passport_number="E%08d" % i, surname="ZHANG",
+            expire_date=today + timedelta(days=90), interview_date=interview,
+            interview_week=interview.isocalendar()[0] * 100 + interview.isocalendar()[1]))
+        records.append(dict(case_id=case_id, status_date=interview, status_id=refused, message_id=refused))
+    with db.begin() as conn:
+        conn.execute(insert(Case.__table__), cases)
+        conn.execute(insert(Record.__table__), records)
+
+
+def scrape():
+    """{(name, labels): value} of the probe's /metrics."""
+    ret = {}
+    for line in requests.get(os.environ["PROBE_URLS"] + "/metrics", timeout=5).text.splitlines():
+        match = re.match(r"(\w+)(\{.*\})? (\S+)$", line)
+        if match:
+            ret[match.group(1), match.group(2) or ""] = float(match.group(3))
+    return ret
+
+
+def quantile(buckets, q):
+    """Linear interpolation inside cumulative histogram buckets [(le, count)]."""
+    total = buckets[-1][1]
+    if not total:
+        return float("nan")
+    rank = q * total
+    prev_le, prev_n = 0.0, 0
+    for le, n in buckets:
+        if n >= rank:
+            if le == float("inf"):
+                return prev_le
+            return prev_le + (le - prev_le) * (rank - prev_n) / max(n - prev_n, 1)
+        prev_le, prev_n = le, n
+    return prev_le
+
+
+def series(before, after, name):
+    """{labels: increase} of one metric between two scrapes."""
+    return {labels: value - before.get((metric, labels), 0) for (metric, labels), value in after.items() if metric == name}
+
+
+def wait_up(url, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            sys.exit("%s exited with %d" % (proc.args, proc.returncode))
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    sys.exit("%s did not come up" % url)
+
+
+def main():
+    seed()
+    print("Seeded %d due cases in %s" % (CASES, DB_PATH))
+    standin = subprocess.Popen([sys.executable, os.path.join(ROOT, "util", "ceac_standin.py")], stdout=subprocess.DEVNULL)
+    probe = subprocess.Popen([sys.executable, os.path.join(ROOT, "probe", "index.py")],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_up("http://127.0.0.1:%s/stats" % STANDIN_PORT, standin)
+        wait_up(os.environ["PROBE_URLS"] + "/metrics", probe)
+        before = scrape()
+        start = time.time()
+        subprocess.run([sys.executable, "-m", "flask", "sync"], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        wall = time.time() - start
+        after = scrape()
+        standin_stats = requests.get("http://127.0.0.1:%s/stats" % STANDIN_PORT, timeout=5).json()
+    finally:
+        probe.terminate()
+        standin.terminate()
+        probe.wait()
+        standin.wait()
+
+    run = db_session.scalars(Select(SyncRun).order_by(SyncRun.id.desc())).first()
+    cases = sorted((float(re.search(r'le="([^"]+)"', labels).group(1)), n)
+        for labels, n in series(before, after, "probe_case_seconds_bucket").items())
+    cpu = after["process_cpu_seconds_total", ""] - before["process_cpu_seconds_total", ""]
+    print("Queried %d of %d cases in %.1fs (sync run %.1fs), %d changed, %d errors, %d deleted" % (
+        run.queried, run.due, wall, run.seconds, run.changed, run.errors, run.deleted))
+    print("Throughput %.0f cases/min" % (run.queried / run.seconds * 60))
+    print("Per case p50 %.2fs p99 %.2fs" % (quantile(cases, 0.5), quantile(cases, 0.99)))
+    print("Probe CPU %.1fs, %.0f ms per case" % (cpu, cpu / max(run.queried, 1) * 1000))
+    stages = series(before, after, "probe_stage_seconds_sum")
+    print("Probe stage seconds", json.dumps({re.search(r'"(\w+)"', k).group(1): round(v, 1) for k, v in stages.items()}))
+    print("Route rate/health", {re.search(r'"([^"]+)"', k).group(1): (round(v, 2), round(after["probe_route_health", k], 2))
+        for k, v in series({}, after, "probe_route_rate").items()})
+    print("Stand-in", json.dumps(standin_stats))
+
+
+if __name__ == "__main__":
+    main()
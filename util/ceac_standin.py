@@ -0,0 +1,139 @@
+# Offline stand-in for the CEAC status site, replaying the pages in util/fixtures.
+# Every page gets a fresh captcha token (one use, like BotDetect), captcha images
+# are random PNGs, and POST results are picked per case number. Point the probe at it:
+#   python util/ceac_standin.py &
+#   CEAC_URL=http://127.0.0.1:8800/CEACStatTracker/Status.aspx?App=NIV python probe/index.py
+# env: STANDIN_PORT (8800), STANDIN_LATENCY mean seconds per request (0.3),
+#      STANDIN_CAPTCHA_FAIL and STANDIN_REJECT rates per POST (0.1, 0.02),
+#      STANDIN_NOCASE and STANDIN_ISSUED shares of case numbers (0.05, 0.1),
+#      STANDIN_MAX_RATE POSTs per second above which every POST is rejected (0, no limit)
+# GET /stats returns the request and outcome counters as JSON.
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PORT = int(os.environ.get("STANDIN_PORT") or 8800)
+LATENCY = float(os.environ.get("STANDIN_LATENCY") or 0.3)
+CAPTCHA_FAIL = float(os.environ.get("STANDIN_CAPTCHA_FAIL") or 0.1)
+REJECT = float(os.environ.get("STANDIN_REJECT") or 0.02)
+NOCASE = float(os.environ.get("STANDIN_NOCASE") or 0.05)
+ISSUED = float(os.environ.get("STANDIN_ISSUED") or 0.1)
+MAX_RATE = float(os.environ.get("STANDIN_MAX_RATE") or 0)
+
+FIXTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+PAGES = {name: open(os.path.join(FIXTURES, name + ".html"), encoding="utf-8").read() for name in
+         ("status_form", "result_captcha", "result_nocase", "result_invalid", "result_issued", "result_ap", "result_rejected")}
+TOKEN = re.compile(r'name="LBD_VCID_[^"]*" id="[^"]*" value="([0-9a-f]+)"')
+CASE_NO = re.compile(r'(_lblCaseNo">)[^<]*(<)')
+STATUS_DATE = re.compile(r'(_lblStatusDate">)[^<]*(<)')
+
+tokens = set()
+posts = deque() # times of the POSTs in the last second
+lock = threading.Lock()
+stats = Counter()
+
+
+def with_token(page):
+    match = TOKEN.search(page)
+    if match is None: # rejected page, no form
+        return page
+    token = uuid.uuid4().hex
+    with lock:
+        tokens.add(token)
+    return page.replace(match.group(1), token)
+
+
+def png(seed, width=200, height=50):
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+
+def over_rate():
+    now = time.monotonic()
+    with lock:
+        posts.append(now)
+        while posts[0] < now - 1:
+            posts.popleft()
+        return MAX_RATE and len(posts) > MAX_RATE
+
+
+def result_page(form):
+    if over_rate() or random.random() < REJECT:
+        return "rejected", PAGES["result_rejected"]
+    token = next((v for k, v in form.items() if k.startswith("LBD_VCID_")), None)
+    with lock:
+        token_ok = token in tokens
+        tokens.discard(token)
+    if not token_ok or random.random() < CAPTCHA_FAIL:
+        return "captcha", PAGES["result_captcha"]
+    case_no = form.get("ctl00$ContentPlaceHolder1$Visa_Case_Number", "")
+    if not form.get("ctl00$ContentPlaceHolder1$Passport_Number"):
+        return "invalid", PAGES["result_invalid"]
+    share = zlib.crc32(case_no.encode()) / 2 ** 32
+    if share < NOCASE:
+        return "nocase", PAGES["result_nocase"]
+    name = "result_issued" if share < NOCASE + ISSUED else "result_ap"
+    page = CASE_NO.sub(lambda m: m.group(1) + case_no + m.group(2), PAGES[name])
+    page = STATUS_DATE.sub(lambda m: m.group(1) + time.strftime("%d-%b-%Y") + m.group(2), page)
+    return name[7:], page
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body: bytes, content_type):
+        time.sleep(max(0.0, random.gauss(LATENCY, LATENCY / 4)))
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/stats":
+            with lock:
+                body = json.dumps(dict(stats, outstanding_tokens=len(tokens))).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if url.path.endswith("BotDetectCaptcha.ashx"):
+            with lock:
+                stats["captcha_get"] += 1
+            return self.reply(png(parse_qs(url.query).get("t", [""])[0]), "image/png")
+        with lock:
+            stats["page_get"] += 1
+        self.reply(with_token(PAGES["status_form"]).encode(), "text/html; charset=utf-8")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+        form = {k: v[0] for k, v in parse_qs(body, keep_blank_values=True).items()}
+        outcome, page = result_page(form)
+        with lock:
+            stats["post"] += 1
+            stats[outcome] += 1
+        self.reply(with_token(page).encode(), "text/html; charset=utf-8")
+
+
+if __name__ == "__main__":
+    print("CEAC stand-in on port", PORT)
+    ThreadingHTTPServer(("", PORT), StandinHandler).serve_forever()
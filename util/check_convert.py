@@ -0,0 +1,61 @@
+# Run util/convert_data.py over the Mongo export samples in util/fixtures, as
+# mongoexport writes them by default (NDJSON) and with --jsonArray [--pretty],
+# and check every format converts to the same cases.
+# usage: python util/check_convert.py
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+UTIL_DIR = os.path.dirname(os.path.realpath(__file__))
+FIXTURES = os.path.join(UTIL_DIR, "fixtures")
+EXPECTED = { # case_no => (last_status, [record statuses])
+    "AA00A1B2C3": ("Issued", ["Refused", "Issued"]),
+    "AA00A1B2D4": (None, []),
+    "AA00A1B2E5": ("Refused", ["Refused"]),
+}
+
+
+def write_export(src, dst, fmt):
+    docs = [json.loads(line) for line in open(src, encoding="utf-8")]
+    with open(dst, "w", encoding="utf-8") as f:
+        if fmt == "ndjson":
+            f.writelines(json.dumps(d, separators=(",", ":")) + "\n" for d in docs)
+        elif fmt == "array":
+            json.dump(docs, f, separators=(",", ":"))
+        else:
+            json.dump(docs, f, indent="\t")
+
+
+def convert(tmp, fmt):
+    case_json, record_json = os.path.join(tmp, fmt + ".case.json"), os.path.join(tmp, fmt + ".record.json")
+    output = os.path.join(tmp, fmt + ".cases.ndjson")
+    write_export(os.path.join(FIXTURES, "mongo_case.ndjson"), case_json, fmt)
+    write_export(os.path.join(FIXTURES, "mongo_record.ndjson"), record_json, fmt)
+    env = dict(os.environ)
+    env.pop("IMPORT_URL", None)
+    proc = subprocess.run([sys.executable, os.path.join(UTIL_DIR, "convert_data.py"), case_json, record_json, output],
+        env=env, capture_output=True, text=True)
+    if proc.returncode:
+        print(proc.stdout, proc.stderr)
+        return None
+    return [json.loads(line) for line in open(output, encoding="utf-8")]
+
+
+def main():
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in ("ndjson", "array", "pretty"):
+            cases = convert(tmp, fmt)
+            got = cases and {c["case_no"]: (c.get("last_status"), [r["status"] for r in c["record_list"]]) for c in cases}
+            if got != EXPECTED:
+                failed += 1
+                print("%-8s MISMATCH %s" % (fmt, got))
+            else:
+                print("%-8s ok, %d cases" % (fmt, len(cases)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
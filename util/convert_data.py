@@ -1,20 +1,48 @@
+# Convert the Mongo exports of the old tracker to an NDJSON dump for the new one.
+# usage: python util/convert_data.py [case.json] [record.json] [out.ndjson]
+# Both mongoexport formats are read, NDJSON (the default) and --jsonArray;
+# util/check_convert.py runs this over the samples in util/fixtures.
+# Records are grouped per case first, then cases are streamed, decrypted in a
+# process pool and written out with their records. Import the output with
+#   flask import_cases CEACStateTracker.cases.ndjson
+# or set IMPORT_URL (e.g. http://localhost:5000/import_case) and SECRET_KEY to
+# upload it in batches of SUBMIT_BATCH cases.
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
 import base64
+import io
 import os
 import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date
 import requests
 from typing import List, TypedDict
 
-private_key_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "private_key.pem")
-private_key = serialization.load_pem_private_key(
-    open(private_key_path, 'rb').read(),
-    password=None,
-)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "web"))
+from importer import DumpReader, batched  # noqa: E402
+
+CASE_JSON = sys.argv[1] if len(sys.argv) > 1 else "CEACStateTracker.case.json"
+RECORD_JSON = sys.argv[2] if len(sys.argv) > 2 else "CEACStateTracker.record.json"
+OUTPUT = sys.argv[3] if len(sys.argv) > 3 else "CEACStateTracker.cases.ndjson"
+DECRYPT_BATCH = 2000
+IMPORT_URL = os.environ.get("IMPORT_URL")
+SUBMIT_BATCH = int(os.environ.get("SUBMIT_BATCH") or 5000)
+
+private_key_path = os.environ.get("PRIVATE_KEY") or os.path.join(os.path.dirname(os.path.realpath(__file__)), "private_key.pem")
+private_key = None # loaded on the first case with an `info` field, once per worker
 
 
 def decrypt(info):
+    global private_key
+    if info is None:
+        return None, None
+    if private_key is None:
+        private_key = serialization.load_pem_private_key(
+            open(private_key_path, 'rb').read(),
+            password=None,
+        )
     plaintext = private_key.decrypt(
         base64.b64decode(info),
         padding.OAEP(
@@ -44,51 +72,68 @@ class Case(TypedDict, total=False):
     interview_date: date
     push_channel: str
     record_list: List[Record]
-    
-
-sorted_case = { } # oid => Case
-
-def read_case_json():
-    data = json.load(open("CEACStateTracker.case.json"))
-    
-    for i in data:
-        passport_number, surname = None, None
-        if "info" in i:
-            passport_number, surname = decrypt(i["info"])
-        case = Case(
-            case_no = i["case_no"],
-            location = i["location"],
-            created_date = datetime.fromisoformat(i["created_date"]["$date"]).date(),
-            passport_number = passport_number,
-            surname = surname,
-            last_check = datetime.fromisoformat(i["last_seem"]["$date"]),
-            #last_status = i["last_status"],
-            interview_date = datetime.fromisoformat(i["interview_date"]["$date"]).date() if i["interview_date"] else None,
-            push_channel = i["push_channel"] if "push_channel" in i else None,
-            record_list = []
-        )
-        sorted_case[i["_id"]["$oid"]] = case
-    
-    data = json.load(open("CEACStateTracker.record.json"))
-    for i in data:
-        record = Record(
-            status_date = datetime.fromisoformat(i["status_date"]["$date"]).date(),
-            status = i["status"],
-            message = i["message"]
-        )
-        tmp = sorted_case[i["case"]["$oid"]]
-        tmp["record_list"].append(record)
-        tmp["last_status"] = record["status"]
-        
-    json.dump(sorted_case, open("CEACStateTracker.sorted_case.json", "w"), default= lambda x: x.isoformat())
 
 
-def submit_case_json():
-    sorted_case = json.load(open("CEACStateTracker.sorted_case.json"))
-    for k,v in sorted_case.items():
-        req = requests.post("http://localhost:5000/import_case", json=v)
-        print(k, v["case_no"], req.text)
+def read_records():
+    """case oid => [(status_date, status, message)], in file order. Status and
+    message texts repeat across cases and are interned."""
+    records = {}
+    for i in DumpReader(open(RECORD_JSON, "rb")):
+        oid = sys.intern(i["case"]["$oid"])
+        records.setdefault(oid, []).append((
+            datetime.fromisoformat(i["status_date"]["$date"]).date().isoformat(),
+            sys.intern(i["status"]),
+            sys.intern(i["message"]),
+        ))
+    return records
+
+
+def convert_case(i, passport_number, surname, records) -> Case:
+    case = Case(
+        case_no = i["case_no"],
+        location = i["location"],
+        created_date = datetime.fromisoformat(i["created_date"]["$date"]).date(),
+        passport_number = passport_number,
+        surname = surname,
+        last_check = datetime.fromisoformat(i["last_seem"]["$date"]),
+        #last_status = i["last_status"],
+        interview_date = datetime.fromisoformat(i["interview_date"]["$date"]).date() if i["interview_date"] else None,
+        push_channel = i["push_channel"] if "push_channel" in i else None,
+        record_list = [Record(status_date=d, status=s, message=m) for d, s, m in records]
+    )
+    if records:
+        case["last_status"] = records[-1][1]
+    return case
+
+
+def write_case_ndjson():
+    start = time.time()
+    records = read_records()
+    print("Read records of %d cases in %.0fs" % (len(records), time.time() - start))
+    count = 0
+    with open(OUTPUT, "w") as out, ProcessPoolExecutor() as pool:
+        for batch in batched(DumpReader(open(CASE_JSON, "rb")), DECRYPT_BATCH):
+            infos = [i.get("info") for i in batch]
+            for i, (passport_number, surname) in zip(batch, pool.map(decrypt, infos, chunksize=100)):
+                case = convert_case(i, passport_number, surname, records.pop(i["_id"]["$oid"], []))
+                out.write(json.dumps(case, ensure_ascii=False, default=lambda x: x.isoformat()) + "\n")
+            count += len(batch)
+            print("Converted %d cases, %.0fs" % (count, time.time() - start))
+    if records:
+        print("Skipped records of %d unknown cases" % len(records))
+
+
+def submit_case_ndjson():
+    with open(OUTPUT, "rb") as dump:
+        for n, lines in enumerate(batched(dump, SUBMIT_BATCH)):
+            req = requests.post(IMPORT_URL, data={"pwd": os.environ.get("SECRET_KEY")},
+                files={"file": ("cases.ndjson", io.BytesIO(b"".join(lines)))}, timeout=600)
+            print("Batch", n, req.status_code, req.text.strip().splitlines()[-3:-1])
+
 
 if __name__ == "__main__":
-    read_case_json()
-    submit_case_json()
\ No newline at end of file
+    write_case_ndjson()
+    if IMPORT_URL:
+        submit_case_ndjson()
+    else:
+        print("Import with: flask import_cases", OUTPUT)
@@ -0,0 +1,148 @@
+"""Processing-time statistics over the Record history, computed with NumPy.
+
+The history is loaded once into flat arrays (one entry per record) and every
+statistic is a handful of vectorized passes over them, so the cost depends on
+the number of records, not on the number of groups or page views."""
+import datetime
+from typing import Dict, NamedTuple
+
+import numpy as np
+from sqlalchemy import Select
+from sqlalchemy.orm import Session
+
+ISSUED = "Issued"
+ADMIN_PROCESSING = "Administrative Processing"
+PERCENTILES = (10, 25, 50, 75, 90)
+HIST_BIN_DAYS = 7
+HIST_BINS = 26 # the last bin also counts everything longer
+
+
+class History(NamedTuple):
+    # per record, sorted by (case, status_date, id)
+    case: np.ndarray
+    status: np.ndarray
+    day: np.ndarray # date.toordinal()
+    # per case
+    location: np.ndarray
+    interview_day: np.ndarray # -1 when unknown
+    interview_week: np.ndarray # -1 when unknown
+    last_check_day: np.ndarray # -1 when never checked
+    location_names: list
+    status_codes: Dict[str, int]
+
+
+def load_history(session: Session, Case, Record, StatusText, batch=20000) -> History:
+    case_index, locations, location_names = {}, {}, []
+    loc_col, iv_day, iv_week, check_day = [], [], [], []
+    for case_id, location, interview_date, interview_week, last_check in session.execute(
+            Select(Case.id, Case.location, Case.interview_date, Case.interview_week, Case.last_check)
+            .execution_options(yield_per=batch)):
+        case_index[case_id] = len(case_index)
+        if location not in locations:
+            locations[location] = len(location_names)
+            location_names.append(location)
+        loc_col.append(locations[location])
+        iv_day.append(interview_date.toordinal() if interview_date else -1)
+        iv_week.append(interview_week or -1)
+        check_day.append(last_check.toordinal() if last_check else -1)
+
+    id_codes = {} # status_text id -> code
+    rec_case, rec_status, rec_day, rec_id = [], [], [], []
+    for rid, case_id, status_id, status_date in session.execute(
+            Select(Record.id, Record.case_id, Record.status_id, Record.status_date).execution_options(yield_per=batch)):
+        idx = case_index.get(case_id)
+        if idx is None: # orphan record
+            continue
+        rec_case.append(idx)
+        rec_status.append(id_codes.setdefault(status_id, len(id_codes)))
+        rec_day.append(status_date.toordinal())
+        rec_id.append(rid)
+    texts = dict(session.execute(Select(StatusText.id, StatusText.text).where(StatusText.id.in_(id_codes.keys()))).all())
+    status_codes = {texts[status_id]: code for status_id, code in id_codes.items()}
+    session.rollback()
+
+    case = np.array(rec_case, dtype=np.int64)
+    day = np.array(rec_day, dtype=np.int64)
+    order = np.lexsort((np.array(rec_id, dtype=np.int64), day, case))
+    return History(
+        case=case[order],
+        status=np.array(rec_status, dtype=np.int64)[order],
+        day=day[order],
+        location=np.array(loc_col, dtype=np.int64),
+        interview_day=np.array(iv_day, dtype=np.int64),
+        interview_week=np.array(iv_week, dtype=np.int64),
+        last_check_day=np.array(check_day, dtype=np.int64),
+        location_names=location_names,
+        status_codes=status_codes,
+    )
+
+
+def group_stats(groups: np.ndarray, values: np.ndarray, labels) -> dict:
+    """Percentiles and a weekly histogram of `values` for every group id, all groups at once."""
+    ret = {}
+    if len(values) == 0:
+        return ret
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    keys, starts, counts = np.unique(groups, return_index=True, return_counts=True)
+    # linear interpolation, same as np.percentile on each group
+    pos = starts[:, None] + (counts[:, None] - 1) * (np.array(PERCENTILES) / 100.0)[None, :]
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    pct = values[lo] + (values[hi] - values[lo]) * (pos - lo)
+    bins = np.clip(values // HIST_BIN_DAYS, 0, HIST_BINS - 1)
+    group_pos = np.searchsorted(keys, groups)
+    hist = np.bincount(group_pos * HIST_BINS + bins, minlength=len(keys) * HIST_BINS).reshape(len(keys), HIST_BINS)
+    for i, key in enumerate(keys):
+        ret[str(labels(key))] = {
+            "n": int(counts[i]),
+            "percentiles": dict(zip(map(str, PERCENTILES), np.round(pct[i], 1).tolist())),
+            "hist": hist[i].tolist(),
+        }
+    return ret
+
+
+def breakdown(h: History, case_idx: np.ndarray, days: np.ndarray) -> dict:
+    """Stats of durations `days` (one per entry of `case_idx`) overall, per location and per interview week."""
+    weeks = h.interview_week[case_idx]
+    has_week = weeks >= 0
+    return {
+        "all": group_stats(np.zeros(len(days), dtype=np.int64), days, lambda _: "all").get("all"),
+        "by_location": group_stats(h.location[case_idx], days, lambda i: h.location_names[i]),
+        "by_week": group_stats(weeks[has_week], days[has_week], int),
+    }
+
+
+def interview_to_issued(h: History) -> dict:
+    code = h.status_codes.get(ISSUED)
+    issued = np.flatnonzero(h.status == code) if code is not None else np.zeros(0, dtype=np.int64)
+    # first Issued record of each case, records are sorted by case then date
+    cases, first = np.unique(h.case[issued], return_index=True)
+    issued_day = h.day[issued[first]]
+    interview = h.interview_day[cases]
+    known = (interview >= 0) & (issued_day >= interview)
+    return breakdown(h, cases[known], issued_day[known] - interview[known])
+
+
+def administrative_processing(h: History) -> dict:
+    code = h.status_codes.get(ADMIN_PROCESSING)
+    if code is None or len(h.case) == 0:
+        return breakdown(h, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    is_ap = h.status == code
+    prev_ap = np.zeros_like(is_ap)
+    prev_ap[1:] = is_ap[:-1] & (h.case[1:] == h.case[:-1])
+    starts = np.flatnonzero(is_ap & ~prev_ap)
+    ends = np.flatnonzero(~is_ap & prev_ap) # first record after a run of AP
+    # every end closes the latest start before it, runs still open have no end
+    opened = starts[np.searchsorted(starts, ends) - 1]
+    return breakdown(h, h.case[ends], h.day[ends] - h.day[opened])
+
+
+def compute(h: History) -> dict:
+    return {
+        "interview_to_issued": interview_to_issued(h),
+        "administrative_processing": administrative_processing(h),
+        "_percentiles_": list(PERCENTILES),
+        "_hist_bin_days_": HIST_BIN_DAYS,
+        "_update_time_": datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + " UTC",
+    }
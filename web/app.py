@@ -1,31 +1,75 @@
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
 import datetime
+import gzip
+import hashlib
+import io
 import json
 import os
+import threading
 import uuid
-from typing import List, Optional
-from flask import Flask, request, flash, abort, make_response, jsonify
+from typing import Dict, Iterable, List, Optional
+from flask import Flask, request, flash, abort, make_response, jsonify, session, stream_with_context
 from flask.templating import render_template
 from werkzeug.utils import redirect
-from sqlalchemy import Integer, Select, String, create_engine, ForeignKey, Date, delete
-from sqlalchemy.orm import relationship, Session, DeclarativeBase, mapped_column, Mapped
-from sqlalchemy import func, Uuid, Text
+from sqlalchemy import Integer, Select, String, create_engine, ForeignKey, Date, delete, insert, update
+from sqlalchemy.orm import relationship, Session, DeclarativeBase, mapped_column, Mapped, aliased, joinedload, scoped_session, sessionmaker
+from sqlalchemy import func, Uuid, Text, event, Index, text, tuple_
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 
 import time
+import click
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from .location_list import LocationDict, LocationList
-from .wechat import wechat_get_qr_code_url, check_wx_signature, xmltodict, wechat_push_msg
+from .wechat import wechat_get_qr_code_url, check_wx_signature, xmltodict, wechat_push_msg, RateLimiter, WechatError, token_stats
+from .sync import ProbeDispatcher, QueryCache, run_pipeline
+from . import analytics, importer, migrations, scheduler
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY")
 
 DB_URL = os.environ.get("DB_URL") or "sqlite:////tmp/ceac.sqlite"
 
-db = create_engine(DB_URL)
-db_session = Session(db)
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT") or 5000) # ms
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE") or 256 * 1024 * 1024)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL") # readers do not block the writer
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % SQLITE_BUSY_TIMEOUT)
+    cursor.execute("PRAGMA mmap_size=%d" % SQLITE_MMAP_SIZE)
+    cursor.close()
+
+def make_engine(url):
+    options = {"pool_pre_ping": True}
+    for env, key, cast in (("DB_POOL_SIZE", "pool_size", int), ("DB_MAX_OVERFLOW", "max_overflow", int),
+                           ("DB_POOL_TIMEOUT", "pool_timeout", float), ("DB_POOL_RECYCLE", "pool_recycle", int)):
+        if os.environ.get(env):
+            options[key] = cast(os.environ[env])
+    engine = create_engine(url, **options)
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+db = make_engine(DB_URL)
+# one session per thread, closed at the end of each request / CLI command / sync chunk
+db_session = scoped_session(sessionmaker(bind=db))
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    db_session.remove()
 
 HOST = os.environ.get("HOST") or "https://track.moyu.ac.cn/detail/"
 REMOTE_URL = os.environ.get("REMOTE_URL") or "http://127.0.0.1:8000"
+# comma separated probe list for `flask sync`, defaults to REMOTE_URL
+PROBE_URLS = (os.environ.get("PROBE_URLS") or REMOTE_URL).split(",")
+PROBE_CONCURRENCY = int(os.environ.get("PROBE_CONCURRENCY") or 2) # in-flight chunks per probe
+SYNC_CHUNK_SIZE = int(os.environ.get("SYNC_CHUNK_SIZE") or 10)
+SYNC_PAGE_SIZE = int(os.environ.get("SYNC_PAGE_SIZE") or 500)
+SYNC_BUDGET = int(os.environ.get("SYNC_BUDGET") or 0) # max cases queried per sync run, 0 for no limit
+PROBE_CACHE_TTL = float(os.environ.get("PROBE_CACHE_TTL") or 60) # seconds a register/refresh result is reused, 0 to only coalesce
 
 EXTENT_DAYS = 120
 
@@ -33,45 +77,184 @@ ERR_NOCASE = "Your search did not return any data."
 ERR_INVCODE = "Invalid Application ID or Case Number."
 COS_URL = os.environ.get("COS_URL")
 PUSH_MSG = os.environ.get("PUSH_MSG","1") == "1"
+PUSH_CONCURRENCY = int(os.environ.get("PUSH_CONCURRENCY") or 4)
+PUSH_RATE = float(os.environ.get("PUSH_RATE") or 10) # messages per second
+PUSH_DAILY_QUOTA = int(os.environ.get("PUSH_DAILY_QUOTA") or 100000) # template message quota of the account
+PUSH_MAX_ATTEMPTS = int(os.environ.get("PUSH_MAX_ATTEMPTS") or 6)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS") or 4) # background queries for /register and refresh, per process
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX") or 100) # queued or running jobs per process before refusing new ones
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT") or 600) # seconds before an unfinished job counts as lost
 
 def parse_date(date_string):
     return datetime.datetime.strptime(date_string,"%d-%b-%Y").date()
 
 def query_ceac_state_safe(loc, case_no, passport_number, surname):
-    retry = 0
-    req = None
-    while retry < 5:
+    delay = 1
+    for retry in range(5):
+        if retry:
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
         try:
             req = requests.post(REMOTE_URL, json=[[loc, case_no, passport_number, surname]], timeout=30)
-            if req.status_code == 200:
-                break
         except Exception as e:
-            pass
-        retry += 1
-        time.sleep(1)
-    if req is None:
-        return "Server Error"
-    return req.json()[case_no]
+            continue
+        if req.status_code == 200:
+            return req.json()[case_no]
+        retry_after = req.headers.get("Retry-After", "")
+        if req.status_code == 503 and retry_after.isdigit(): # probe busy, wait as long as it asks
+            delay = max(delay, min(int(retry_after), 30))
+    return "Server Error"
+
 
+query_cache = QueryCache(PROBE_CACHE_TTL)
+
+def query_ceac_state_cached(loc, case_no, passport_number, surname):
+    """(checked_at, result) of query_ceac_state_safe, shared by identical
+    queries in flight and reused for PROBE_CACHE_TTL when not an error."""
+    key = hashlib.sha256("\0".join(str(i) for i in (loc, case_no, passport_number, surname)).encode()).hexdigest()
+    return query_cache.get(key, lambda: query_ceac_state_safe(loc, case_no, passport_number, surname),
+        cacheable=lambda result: not isinstance(result, str))
 
-def query_ceac_state_batch(req_data):
-    return requests.post(REMOTE_URL, json=req_data, timeout=1800).json()
 
 class Base(DeclarativeBase):
     pass
 
+class StatusText(Base):
+    """The few dozen status and message texts CEAC returns, stored once and
+    referenced by records. Rows are only ever added."""
+    __tablename__ = "status_text"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    text :Mapped[str] = mapped_column(Text)
+    digest :Mapped[str] = mapped_column(String(40), unique=True) # sha1 of text, MySQL cannot index TEXT as unique
+
+    @staticmethod
+    def digest_of(text):
+        return hashlib.sha1(text.encode()).hexdigest()
+
+
+def insert_ignore(session, table):
+    """INSERT that skips rows violating a unique constraint."""
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return insert(table).prefix_with("IGNORE", dialect="mysql")
+
+
+def upsert(conn, table, set_):
+    """INSERT that updates the row it conflicts with instead. `set_(new)` gives
+    the {column: expression} to update, `new` being the row not inserted."""
+    dialect = (conn.get_bind() if hasattr(conn, "get_bind") else conn).dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        stmt = (sqlite if dialect == "sqlite" else postgresql).insert(table)
+        return stmt.on_conflict_do_update(index_elements=table.primary_key.columns, set_=set_(stmt.excluded))
+    stmt = mysql.insert(table)
+    return stmt.on_duplicate_key_update(set_(stmt.inserted))
+
+
+class StatusTextCache:
+    """In-process map between status_text ids and texts. Committed rows never
+    change, so they are cached for good; rows inserted by a transaction stay
+    in its session.info until it commits and are dropped if it rolls back."""
+    def __init__(self):
+        self.by_id = {}
+        self.by_text = {}
+
+    def add(self, ids: Dict[str, int]):
+        for text, id in ids.items():
+            self.by_text[text] = id
+            self.by_id[id] = text
+
+    def _lookup(self, session, texts):
+        digests = {StatusText.digest_of(t): t for t in texts}
+        rows = session.execute(Select(StatusText.id, StatusText.digest).where(StatusText.digest.in_(digests.keys())))
+        return {digests[digest]: id for id, digest in rows}
+
+    def ids(self, session, texts: Iterable[str]) -> Dict[str, int]:
+        """Ids of `texts`, inserting the ones not seen before."""
+        pending = session.info.get("status_texts", {})
+        ret, missing = {}, []
+        for text in set(texts):
+            id = self.by_text.get(text) or pending.get(text)
+            if id is None:
+                missing.append(text)
+            else:
+                ret[text] = id
+        if missing:
+            found = self._lookup(session, missing) # committed rows, other transactions' are not visible
+            self.add(found)
+            ret.update(found)
+            new = [t for t in missing if t not in found]
+            if new:
+                session.execute(insert_ignore(session, StatusText.__table__),
+                    [{"text": t, "digest": StatusText.digest_of(t)} for t in new])
+                found = self._lookup(session, new)
+                session.info.setdefault("status_texts", {}).update(found)
+                ret.update(found)
+                late = [t for t in new if t not in found]
+                if late:
+                    # Ignored as duplicates of rows committed after this transaction's
+                    # snapshot (MySQL REPEATABLE READ), so read them outside of it.
+                    with db.connect() as conn:
+                        found = self._lookup(conn, late)
+                    self.add(found)
+                    ret.update(found)
+        return ret
+
+    def text(self, session, id) -> str:
+        text = self.by_id.get(id)
+        if text is None:
+            pending = {i: t for t, i in session.info.get("status_texts", {}).items()}
+            if id in pending:
+                return pending[id]
+            # the table is small, warm the whole cache at once
+            self.add({t: i for i, t in session.execute(Select(StatusText.id, StatusText.text)) if i not in pending})
+            text = self.by_id[id]
+        return text
+
+status_texts = StatusTextCache()
+
+@event.listens_for(Session, "after_commit")
+def cache_status_texts(session):
+    status_texts.add(session.info.pop("status_texts", {}))
+
+@event.listens_for(Session, "after_rollback")
+def drop_status_texts(session):
+    session.info.pop("status_texts", None)
+
+
 class Record(Base):
     __tablename__ = "record"
+    __table_args__ = (
+        Index("ix_record_case_id_status_date", "case_id", "status_date"),
+    )
     id: Mapped[int] = mapped_column(
         primary_key=True, index=True, autoincrement=True
     )
     case_id:Mapped[uuid.UUID] = mapped_column(Uuid, ForeignKey("case.id"))
     status_date :Mapped[datetime.date] = mapped_column(Date)
-    status :Mapped[str] = mapped_column(String(50))
-    message :Mapped[str] = mapped_column(Text)
+    status_id :Mapped[int] = mapped_column(ForeignKey("status_text.id"))
+    message_id :Mapped[int] = mapped_column(ForeignKey("status_text.id"))
+
+    @property
+    def status(self) -> str:
+        return status_texts.text(db_session, self.status_id)
+
+    @property
+    def message(self) -> str:
+        return status_texts.text(db_session, self.message_id)
+
+LatestRecord = aliased(Record)
 
 class Case(Base):
     __tablename__ = "case"
+    __table_args__ = (
+        # active cases in the sync's keyset order (next_check_at, id), expire_date included
+        # so skipped rows need no table lookup; partial where supported, composite on MySQL
+        Index("ix_case_due", "next_check_at", "id", "expire_date",
+            sqlite_where=text("passport_number IS NOT NULL"), postgresql_where=text("passport_number IS NOT NULL")),
+    )
     id: Mapped[uuid.UUID] = mapped_column(Uuid,
         primary_key=True, index=True, default=uuid.uuid4
     )
@@ -79,7 +262,8 @@ class Case(Base):
     location :Mapped[str] = mapped_column(String(5))
     created_date :Mapped[datetime.date] = mapped_column(default=datetime.datetime.now)
     last_check :Mapped[Optional[datetime.datetime]] = mapped_column()
-    last_status : Mapped[Optional[str]] = mapped_column(String(50))
+    next_check_at :Mapped[Optional[datetime.datetime]] = mapped_column(default=datetime.datetime.now) # see scheduler.py
+    last_status : Mapped[Optional[str]] = mapped_column(String(50), active_history=True)
     passport_number :Mapped[Optional[str]] = mapped_column(String(20))
     surname :Mapped[Optional[str]] = mapped_column(String(10))
 
@@ -88,7 +272,7 @@ class Case(Base):
     qr_code_expire :Mapped[Optional[datetime.datetime]] = mapped_column()
     expire_date :Mapped[Optional[datetime.date]] = mapped_column()
     interview_date :Mapped[Optional[datetime.date]] = mapped_column()
-    interview_week :Mapped[Optional[int]] = mapped_column() # for stat group by week
+    interview_week :Mapped[Optional[int]] = mapped_column(active_history=True) # for stat group by week
 
     record_list :Mapped[List["Record"]] = relationship(cascade="all, delete-orphan", order_by="desc(Record.status_date)", foreign_keys="Record.case_id")
 
@@ -101,44 +285,83 @@ class Case(Base):
         return self.record_list[0] if self.record_list else None
 
     @staticmethod
-    def updateRecord(case_no, result, push_msg=True):
-        stmt = Select(Case).where(Case.case_no == case_no)
-        case_: Case = db_session.scalars(stmt).first()
-        status, _, status_date, message = result
-        case_.last_check = datetime.datetime.now()
-        db_session.commit()
-        status_date = parse_date(status_date)
-        if case_.last_update != None and \
-            case_.last_update.status_date == status_date and \
-            case_.last_update.status == status and \
-            case_.last_update.message == message:
-            # no update needed
-            return
-        new_record = Record(case_id=case_.id, status_date=status_date, status=status, message=message)
-        db_session.add(new_record)
-        case_.last_status = status_date
-        db_session.commit()
-        db_session.refresh(new_record)
-        if status == "Issued":
-            case_.expire_date = None
-            case_.passport_number = None
-            case_.surname = None
+    def updateRecord(case_no, result, push_msg=True, checked_at=None):
+        Case.updateRecords({case_no: result}, push_msg, checked_at=checked_at)
+
+    @staticmethod
+    def updateRecords(result_dict, push_msg=True, delete_nocase=False, checked_at=None):
+        """Apply a chunk of probe results {case_no: result} with one SELECT for
+        the cases and their latest records, one bulk insert, one bulk update and
+        a single commit. Error results are skipped and retried after the
+        minimum interval, except ERR_NOCASE which deletes the case when
+        `delete_nocase` is set. `checked_at` is when the probe answered, for
+        cached results. Returns the number of changed cases."""
+        results = {k: v for k, v in result_dict.items() if isinstance(v, (list, tuple))}
+        nocase = [k for k, v in result_dict.items() if delete_nocase and v == ERR_NOCASE]
+        failed = [k for k in result_dict.keys() if k not in results and k not in nocase]
+        now = checked_at or datetime.datetime.now()
+        schedule = current_schedule()
+        new_records, case_values = [], []
+        stat_deltas = Counter()
+        if results:
+            text_ids = status_texts.ids(db_session, [r[0] for r in results.values()] + [r[3] for r in results.values()])
+            latest_id = Select(LatestRecord.id).where(LatestRecord.case_id == Case.id) \
+                .order_by(LatestRecord.status_date.desc(), LatestRecord.id.desc()).limit(1) \
+                .correlate(Case).scalar_subquery()
+            stmt = Select(Case, Record).outerjoin(Record, Record.id == latest_id).where(Case.case_no.in_(results.keys()))
+            for case_, last_update in db_session.execute(stmt):
+                status, _, status_date, message = results[case_.case_no]
+                status_date = parse_date(status_date)
+                values = {"id": case_.id, "last_check": now,
+                    "next_check_at": now + schedule.interval(status, (now.date() - status_date).days)}
+                case_values.append(values)
+                if last_update != None and \
+                    last_update.status_date == status_date and \
+                    last_update.status_id == text_ids[status] and \
+                    last_update.message_id == text_ids[message]:
+                    # no update needed
+                    continue
+                new_records.append({"case_id": case_.id, "status_date": status_date,
+                    "status_id": text_ids[status], "message_id": text_ids[message]})
+                values["last_status"] = status
+                stat_deltas[(case_.interview_week, case_.last_status)] -= 1
+                stat_deltas[(case_.interview_week, status)] += 1
+                if status == "Issued":
+                    values.update(expire_date=None, passport_number=None, surname=None)
+                if case_.push_channel and push_msg:
+                    case_.push_msg(remark=message, status=status)
+        if new_records:
+            db_session.execute(insert(Record), new_records)
+        if case_values:
+            db_session.execute(update(Case), case_values)
+            detail_cache.invalidate([values["id"] for values in case_values])
+        if failed:
+            db_session.execute(update(Case).where(Case.case_no.in_(failed))
+                .values(next_check_at=now + datetime.timedelta(hours=scheduler.SCHEDULE_MIN_HOURS)))
+        if nocase:
+            for week, status in db_session.execute(Select(Case.interview_week, Case.last_status).where(Case.case_no.in_(nocase))):
+                stat_deltas[(week, status)] -= 1
+            case_ids = Select(Case.id).where(Case.case_no.in_(nocase))
+            db_session.execute(delete(Record).where(Record.case_id.in_(case_ids)), execution_options={"synchronize_session": False})
+            db_session.execute(delete(Case).where(Case.case_no.in_(nocase)), execution_options={"synchronize_session": False})
+        StatCount.apply(db_session, stat_deltas)
         db_session.commit()
-        if case_.push_channel and push_msg:
-            case_.push_msg()
+        return len(new_records)
 
     def renew(self, days=EXTENT_DAYS):
         if self.last_status == "Issued":
             return
         self.expire_date = (datetime.datetime.today() + datetime.timedelta(days=days)).date()
 
-    def push_msg(self, first=None, remark=None):
+    def push_msg(self, first=None, remark=None, status=None):
+        """Queue a notification in the outbox, it is sent by `flask push`
+        once the current transaction commits."""
         first = first or "你的签证状态有更新"
         keyword1 = self.marked_case_no
-        keyword2 = self.last_status
-        remark = self.last_update.message
-        wechat_push_msg(self.push_channel, msg_url=HOST+str(self.id),
-            first=first, keyword1=keyword1, keyword2=keyword2, remark=remark)
+        keyword2 = status or self.last_status
+        remark = remark or (self.last_update.message if self.last_update else "")
+        db_session.add(PushMessage(touser=self.push_channel, msg_url=HOST+str(self.id),
+            data=json.dumps(dict(first=first, keyword1=keyword1, keyword2=keyword2, remark=remark))))
 
     def get_qr_code_url(self):
         if self.qr_code_expire is None or datetime.datetime.now() > self.qr_code_expire:
@@ -155,16 +378,145 @@ class Case(Base):
         if not case:
             return 
         case.push_channel = wx_userid
-        db_session.commit()
         case.push_msg(first="签证状态的更新会推送到这里")
+        db_session.commit()
+
+class StatCount(Base):
+    """Number of cases per (interview_week, last_status), maintained on every
+    change instead of a GROUP BY over all cases. Rebuild with `flask rebuild_stat`."""
+    __tablename__ = "stat_count"
+    interview_week :Mapped[int] = mapped_column(primary_key=True)
+    status :Mapped[str] = mapped_column(String(50), primary_key=True)
+    count :Mapped[int] = mapped_column(default=0)
+    updated :Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+
+    @staticmethod
+    def apply(conn, deltas):
+        """Add {(interview_week, status): delta} to the counts, `conn` is a Session or Connection."""
+        table = StatCount.__table__
+        now = datetime.datetime.now()
+        keys = sorted(k for k, delta in deltas.items() if None not in k and delta != 0) # same lock order in every transaction
+        rows = [dict(interview_week=week, status=status, count=deltas[(week, status)], updated=now) for week, status in keys]
+        if rows:
+            conn.execute(upsert(conn, table, lambda new: {"count": table.c.count + new.count, "updated": new.updated}), rows)
+
+
+@event.listens_for(Session, "before_flush")
+def update_stat_count(session, flush_context, instances):
+    # ORM changes to a case's week/status; bulk statements call StatCount.apply themselves
+    deltas = Counter()
+    for case in session.new:
+        if isinstance(case, Case):
+            deltas[(case.interview_week, case.last_status)] += 1
+    for case in session.deleted:
+        if isinstance(case, Case):
+            deltas[(case.interview_week, case.last_status)] -= 1
+    for case in session.dirty:
+        if not isinstance(case, Case):
+            continue
+        week, status = get_history(case, "interview_week"), get_history(case, "last_status")
+        if not week.has_changes() and not status.has_changes():
+            continue
+        old = lambda h: h.deleted[0] if h.deleted else (h.unchanged[0] if h.unchanged else None)
+        deltas[(old(week), old(status))] -= 1
+        deltas[(case.interview_week, case.last_status)] += 1
+    if deltas:
+        StatCount.apply(session.connection(), deltas)
+
+
+class Snapshot(Base):
+    """Rendered artifacts (e.g. stat.js) and their digest, to skip uploads that would not change anything."""
+    __tablename__ = "snapshot"
+    name :Mapped[str] = mapped_column(String(50), primary_key=True)
+    content :Mapped[str] = mapped_column(Text)
+    digest :Mapped[str] = mapped_column(String(64))
+    updated :Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+
+    @staticmethod
+    def save(name, content, digest=None):
+        snapshot = db_session.get(Snapshot, name)
+        if snapshot is None:
+            snapshot = Snapshot(name=name)
+            db_session.add(snapshot)
+        snapshot.content = content
+        snapshot.digest = digest or hashlib.sha1(content.encode()).hexdigest()
+        snapshot.updated = datetime.datetime.now()
+        db_session.commit()
+
+
+class PushMessage(Base):
+    """Outbox of WeChat template messages, drained by `flask push`."""
+    __tablename__ = "push_outbox"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    touser :Mapped[str] = mapped_column(String(100))
+    msg_url :Mapped[str] = mapped_column(String(200))
+    data :Mapped[str] = mapped_column(Text) # json of template keywords
+    created :Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+    next_try :Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now, index=True)
+    attempts :Mapped[int] = mapped_column(default=0)
+    sent :Mapped[Optional[datetime.datetime]] = mapped_column(index=True)
+    last_error :Mapped[Optional[str]] = mapped_column(String(200))
+
+class SyncRun(Base):
+    """One `flask sync`, counters updated after every chunk so a run that
+    overruns or dies is visible too (finished stays empty)."""
+    __tablename__ = "sync_run"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    started :Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now, index=True)
+    finished :Mapped[Optional[datetime.datetime]] = mapped_column()
+    due :Mapped[int] = mapped_column(default=0) # cases due when the run started
+    queried :Mapped[int] = mapped_column(default=0)
+    changed :Mapped[int] = mapped_column(default=0)
+    errors :Mapped[int] = mapped_column(default=0)
+    deleted :Mapped[int] = mapped_column(default=0)
+    chunks :Mapped[int] = mapped_column(default=0)
+    failed_chunks :Mapped[int] = mapped_column(default=0)
+
+    @property
+    def seconds(self):
+        return ((self.finished or datetime.datetime.now()) - self.started).total_seconds()
+
+
+class SyncChunk(Base):
+    __tablename__ = "sync_chunk"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    run_id :Mapped[int] = mapped_column(ForeignKey("sync_run.id"), index=True)
+    probe :Mapped[Optional[str]] = mapped_column(String(200))
+    size :Mapped[int] = mapped_column()
+    attempts :Mapped[int] = mapped_column()
+    seconds :Mapped[float] = mapped_column()
+    ok :Mapped[bool] = mapped_column()
+    finished :Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now)
+
+
+class ProbeJob(Base):
+    """A CEAC query for /register or a detail refresh, run by the job workers
+    and polled on /job/<id>. Passport number and surname only live in memory
+    while the job runs, the table keeps the outcome."""
+    __tablename__ = "probe_job"
+    id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
+    kind :Mapped[str] = mapped_column(String(10)) # register or refresh
+    case_no :Mapped[str] = mapped_column(String(20), index=True)
+    state :Mapped[str] = mapped_column(String(10), default="queued") # queued, running, done
+    result :Mapped[Optional[str]] = mapped_column(Text) # json response for the client
+    created :Mapped[datetime.datetime] = mapped_column(default=datetime.datetime.now, index=True)
+    finished :Mapped[Optional[datetime.datetime]] = mapped_column()
+
 
 @app.route("/init_db")
 def init_db():
     pwd = request.args.get("pwd")
     if pwd != os.environ.get("SECRET_KEY"):
         return "Need Pwd"
-    Base.metadata.create_all(db, checkfirst=True)
-    return "OK"
+    version = migrations.upgrade(db, Base.metadata)
+    return "OK, schema version %d" % version
+
+
+@app.cli.command('migrate', help="Apply pending schema migrations")
+@click.option("--to", "target", type=int, default=None, help="Stop at this version")
+def migrate(target):
+    version = migrations.upgrade(db, Base.metadata, target)
+    print("Schema version", version)
 
 
 def divide_chunks(l, n):
@@ -172,32 +524,172 @@ def divide_chunks(l, n):
         yield l[i:i + n]
 
 
+def iter_due_chunks(chunk_size=SYNC_CHUNK_SIZE, page_size=SYNC_PAGE_SIZE, budget=SYNC_BUDGET):
+    # Due cases, most overdue first, in keyset pages on a separate session: memory
+    # stays flat and no read cursor is held open while the writer commits on db_session.
+    now = datetime.datetime.now()
+    last = None
+    left = budget or None
+    with Session(db) as session:
+        while left is None or left > 0:
+            stmt = Select(Case.next_check_at, Case.id, Case.location, Case.case_no, Case.passport_number, Case.surname)\
+                .where(Case.expire_date >= datetime.datetime.today(), Case.next_check_at <= now, Case.passport_number != None)\
+                .order_by(Case.next_check_at, Case.id).limit(page_size if left is None else min(page_size, left))
+            if last is not None:
+                stmt = stmt.where(tuple_(Case.next_check_at, Case.id) > last)
+            rows = session.execute(stmt).all()
+            session.rollback()
+            if not rows:
+                return
+            last = tuple(rows[-1][:2])
+            if left is not None:
+                left -= len(rows)
+            for chunk in divide_chunks(rows, chunk_size):
+                yield [tuple(i[2:]) for i in chunk]
+
+
+def apply_sync_result(req_data, result_dict):
+    for case_no ,result in result_dict.items():
+        print("Updating" ,case_no, result)
+    # ERR_NOCASE: expire case without interview
+    return Case.updateRecords(result_dict, PUSH_MSG, delete_nocase=True)
+
+
 @app.cli.command('sync', help="Sync all case status")
 def crontab_task():
     print("Start sync at", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
-    last_check_expire = datetime.datetime.now() - datetime.timedelta(hours=6)
-    stmt = Select(Case.location, Case.case_no, Case.passport_number, Case.surname)\
-        .where(Case.expire_date >= datetime.datetime.today(), Case.last_check <= last_check_expire, Case.passport_number != None)
-    case_list = db_session.execute(stmt).all()
-    for req_data in divide_chunks(case_list, 10):
-        req_data = [tuple(i) for i in req_data]
-        print("Querying", [case[1] for case in req_data])
-        result_dict = query_ceac_state_batch(req_data)
-        for case_no ,result in result_dict.items():
-            print("Updating" ,case_no, result)
-            if isinstance(result, list):
-                Case.updateRecord(case_no,result, PUSH_MSG)
-            else: # Error message
-                if result == ERR_NOCASE: # expire case without interview
-                    stmt = Select(Case).where(Case.case_no == case_no)
-                    case = db_session.scalars(stmt).first()
-                    if case:
-                        db_session.delete(case)
-                        db_session.commit()
+    dispatcher = ProbeDispatcher(PROBE_URLS, PROBE_CONCURRENCY)
+    due = db_session.scalar(Select(func.count()).select_from(Case).where(Case.expire_date >= datetime.datetime.today(),
+        Case.next_check_at <= datetime.datetime.now(), Case.passport_number != None))
+    run = SyncRun(due=due)
+    db_session.add(run)
+    db_session.commit()
+    run_id = run.id
+    def chunks():
+        for req_data in iter_due_chunks():
+            print("Querying", [case[1] for case in req_data])
+            yield req_data
+    def apply(req_data, result_dict, report):
+        changed = apply_sync_result(req_data, result_dict)
+        deleted = sum(1 for v in result_dict.values() if v == ERR_NOCASE)
+        errors = len(req_data) - sum(1 for v in result_dict.values() if isinstance(v, (list, tuple))) - deleted
+        db_session.add(SyncChunk(run_id=run_id, size=len(req_data), **report))
+        db_session.execute(update(SyncRun).where(SyncRun.id == run_id).values(queried=SyncRun.queried + len(req_data),
+            changed=SyncRun.changed + changed, errors=SyncRun.errors + errors, deleted=SyncRun.deleted + deleted,
+            chunks=SyncRun.chunks + 1, failed_chunks=SyncRun.failed_chunks + (0 if report["ok"] else 1)))
+        db_session.commit()
+        db_session.remove()
+    run_pipeline(chunks(), dispatcher, apply)
+    db_session.execute(update(SyncRun).where(SyncRun.id == run_id).values(finished=datetime.datetime.now()))
+    db_session.execute(delete(ProbeJob).where(ProbeJob.created < datetime.datetime.now() - datetime.timedelta(days=1)))
+    db_session.commit()
+    run = db_session.get(SyncRun, run_id)
+    print("Queried %d of %d due cases in %.0fs, %d changed, %d errors, %d deleted" % (
+        run.queried, run.due, run.seconds, run.changed, run.errors, run.deleted))
+    for endpoint in dispatcher.endpoints:
+        print("Probe", endpoint.url, "health %.2f" % endpoint.health, "latency", endpoint.latency)
     if COS_URL:
         status_code = stat_result()
         print("Put stat.js to COS", COS_URL, status_code)
+    update_analytics()
     
+def push_retry_delay(attempts):
+    return datetime.timedelta(minutes=min(2 ** attempts, 360))
+
+
+@app.cli.command('push', help="Send queued WeChat notifications")
+@click.option("--once", is_flag=True, help="Exit when the outbox is empty")
+def push_worker(once):
+    limiter = RateLimiter(PUSH_RATE)
+    def send(msg: PushMessage):
+        limiter.wait()
+        wechat_push_msg(msg.touser, msg_url=msg.msg_url, **json.loads(msg.data))
+    with ThreadPoolExecutor(max_workers=PUSH_CONCURRENCY) as pool:
+        while True:
+            now = datetime.datetime.now()
+            sent_today = db_session.scalar(Select(func.count()).select_from(PushMessage) \
+                .where(PushMessage.sent >= now - datetime.timedelta(days=1)))
+            budget = min(PUSH_DAILY_QUOTA - sent_today, 100)
+            stmt = Select(PushMessage).where(PushMessage.sent == None, PushMessage.next_try <= now,
+                PushMessage.attempts < PUSH_MAX_ATTEMPTS).order_by(PushMessage.id).limit(max(budget, 0))
+            batch = db_session.scalars(stmt).all() if budget > 0 else []
+            if not batch:
+                db_session.rollback()
+                if once:
+                    break
+                time.sleep(60 if budget <= 0 else 5)
+                continue
+            futures = [(msg, pool.submit(send, msg)) for msg in batch]
+            for msg, f in futures:
+                try:
+                    f.result()
+                    msg.sent = datetime.datetime.now()
+                except Exception as e:
+                    msg.attempts += 1
+                    msg.last_error = str(e)[:200]
+                    msg.next_try = datetime.datetime.now() + push_retry_delay(msg.attempts)
+                    if isinstance(e, WechatError) and e.errcode in WechatError.PERMANENT:
+                        msg.attempts = PUSH_MAX_ATTEMPTS
+            db_session.commit()
+            print("Pushed", sum(1 for msg, _ in futures if msg.sent), "of", len(futures))
+            db_session.remove()
+
+
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE") or 500)
+
+def import_batch(batch):
+    """Insert a batch of exported cases with one existence check and two bulk
+    inserts, yielding a line per skipped case and one for the batch."""
+    case_nos = [c.get("case_no") for c in batch if isinstance(c, dict) and isinstance(c.get("case_no"), str)]
+    existing = set(db_session.scalars(Select(Case.case_no).where(Case.case_no.in_(case_nos))))
+    cases, records = [], []
+    stat_deltas = Counter()
+    for c in batch:
+        if not isinstance(c, dict):
+            yield f"{json.dumps(c)[:40]}: Invalid case (not an object)\n"
+            continue
+        case_no = c.get("case_no")
+        if not isinstance(case_no, str):
+            yield f"{json.dumps(case_no)[:40]}: Invalid case (case_no is not a string)\n"
+            continue
+        if case_no in existing:
+            yield f"{case_no}: Case_no exists\n"
+            continue
+        try:
+            case, case_records = importer.case_rows(c, EXTENT_DAYS)
+        except (KeyError, TypeError, ValueError) as e:
+            yield f"{case_no}: Invalid case ({e!r})\n"
+            continue
+        existing.add(case_no)
+        cases.append(case)
+        records.extend(case_records)
+        stat_deltas[(case["interview_week"], case["last_status"])] += 1
+    # Core inserts: one executemany per table, column defaults filled in per row
+    if cases:
+        db_session.execute(insert(Case.__table__), cases)
+    if records:
+        text_ids = status_texts.ids(db_session, [r["status"] for r in records] + [r["message"] for r in records])
+        for r in records:
+            r["status_id"], r["message_id"] = text_ids[r.pop("status")], text_ids[r.pop("message")]
+        db_session.execute(insert(Record.__table__), records)
+    StatCount.apply(db_session, stat_deltas)
+    db_session.commit()
+    yield f"{len(cases)} cases, {len(records)} records imported\n"
+
+
+def import_stream(fp, batch_size=IMPORT_BATCH_SIZE):
+    total = 0
+    try:
+        for batch in importer.batched(importer.DumpReader(fp), batch_size):
+            for line in import_batch(batch):
+                yield line
+            total += len(batch)
+            yield f"-- {total} read\n"
+    except ValueError as e: # includes json.JSONDecodeError
+        db_session.rollback()
+        yield f"Stopped, malformed input after {total} cases: {e}\n"
+
+
 @app.route("/import_case", methods=["GET","POST"])
 def import_case():
     if request.method == "GET":
@@ -206,50 +698,25 @@ def import_case():
         return "Need Pwd"
     if "file" not in request.files:
         return "No file part"
-    file = request.files["file"]
-    case_list = json.load(file)
-    if type(case_list) == dict:
-        case_list = case_list.values()
+    # the request closes its files when the view returns, keep the upload for the stream
+    upload, request.files["file"].stream = request.files["file"].stream, io.BytesIO()
     def generate():
         yield "<pre>"
         yield "importing...\n"
-        for c in case_list:
-            case_no = c["case_no"]
-            stmt = Select(Case.id).where(Case.case_no == case_no)
-            if db_session.scalars(stmt).first():
-                yield f"{case_no}: Case_no exists\n"
-                db_session.rollback()
-                continue
-            case = Case(
-                case_no = case_no,
-                location = c["location"],
-                created_date = datetime.date.fromisoformat(c["created_date"]),
-                passport_number = c["passport_number"],
-                surname = c["surname"],
-                last_check = datetime.datetime.fromisoformat(c["last_check"]),
-                last_status = c["last_status"],
-                push_channel = c["push_channel"],
-            )
-            if c["interview_date"]:
-                case.interview_date = datetime.date.fromisoformat(c["interview_date"])
-                case.interview_week = case.interview_date.isocalendar()[0]*100 + case.interview_date.isocalendar()[1]
-            case.expire_date = datetime.date.today() + datetime.timedelta(days=120) if case.last_status != "Issued" else None
-            db_session.add(case)
-            db_session.commit()
-            db_session.refresh(case)
-            for r in c["record_list"]:
-                record = Record(
-                    case_id = case.id,
-                    status_date = datetime.date.fromisoformat(r["status_date"]),
-                    status = r["status"],
-                    message = r["message"]
-                )
-                db_session.add(record)
-            db_session.commit()
-            yield f"{case_no}: OK\n"
-            yield "</pre>"
-    return generate()
-    
+        with upload:
+            for line in import_stream(upload):
+                yield line
+        yield "</pre>"
+    return stream_with_context(generate())
+
+
+@app.cli.command('import_cases', help="Import cases from a JSON array, JSON object or NDJSON dump")
+@click.argument("dump", type=click.File("rb"))
+@click.option("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+def import_cases(dump, batch_size):
+    for line in import_stream(dump, batch_size):
+        print(line, end="")
+
 @app.route("/health")
 def health():
     return "OK"
@@ -278,9 +745,13 @@ def register():
         return jsonify({"status":"error", "error":"Invaild case no"})
     if not location or location not in LocationDict.keys() :
         return jsonify({"status":"error", "error":"Invaild location"})
-    result = query_ceac_state_safe(location, case_no, passport_number, surname)
+    return submit_job("register", case_no, run_register, location, case_no, passport_number, surname)
+
+
+def run_register(location, case_no, passport_number, surname):
+    checked_at, result = query_ceac_state_cached(location, case_no, passport_number, surname)
     if isinstance(result,str):
-        return jsonify({"status":"error", "error":result})
+        return {"status":"error", "error":result}
     stmt = Select(Case).where(Case.case_no == case_no)
     case = db_session.scalars(stmt).first()
     if case: # update the old case
@@ -290,18 +761,89 @@ def register():
     else:
         case = Case(case_no=case_no,location=location, created_date=parse_date(result[1]), passport_number=passport_number, surname=surname)
         db_session.add(case)
-    Case.updateRecord(case_no, result)
+    Case.updateRecord(case_no, result, checked_at=checked_at)
     case.renew()
     db_session.commit()
-    return jsonify({"status":"success", "case_id":str(case.id)})
+    return {"status":"success", "case_id":str(case.id)}
+
+
+def run_refresh(location, case_no, passport_number, surname):
+    checked_at, result = query_ceac_state_cached(location, case_no, passport_number, surname)
+    if isinstance(result,str):
+        return {"status":"error", "error":result}
+    Case.updateRecord(case_no, result, checked_at=checked_at)
+    return {"status":"success", "title": result[0], "message": result[3]}
+
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+job_slots = threading.BoundedSemaphore(JOB_QUEUE_MAX)
+
+
+def submit_job(kind, case_no, fn, *args):
+    """Queue `fn(*args)` on the job workers and answer with the job id. The
+    arguments stay in memory, only kind, case and outcome are stored."""
+    if kind == "refresh":
+        stmt = Select(ProbeJob).where(ProbeJob.case_no == case_no, ProbeJob.kind == kind, ProbeJob.state != "done",
+            ProbeJob.created > datetime.datetime.now() - datetime.timedelta(seconds=JOB_TIMEOUT))
+        job = db_session.scalars(stmt).first()
+        if job is not None: # one refresh of a case at a time
+            return jsonify({"status":"queued", "job_id":str(job.id)})
+    if not job_slots.acquire(blocking=False):
+        return jsonify({"status":"error", "error":"Server busy, please try again later"})
+    try:
+        job = ProbeJob(kind=kind, case_no=case_no)
+        db_session.add(job)
+        db_session.commit()
+        job_executor.submit(run_job, job.id, fn, *args)
+    except BaseException:
+        job_slots.release() # run_job releases it once the job is submitted
+        raise
+    return jsonify({"status":"queued", "job_id":str(job.id)})
+
+
+def run_job(job_id, fn, *args):
+    try:
+        with app.app_context():
+            db_session.execute(update(ProbeJob).where(ProbeJob.id == job_id).values(state="running"))
+            db_session.commit()
+            try:
+                result = fn(*args)
+            except Exception:
+                app.logger.exception("Job %s failed", job_id)
+                db_session.rollback()
+                result = {"status":"error", "error":"Server Error"}
+            db_session.execute(update(ProbeJob).where(ProbeJob.id == job_id)
+                .values(state="done", result=json.dumps(result), finished=datetime.datetime.now()))
+            db_session.commit()
+    finally:
+        job_slots.release()
+
+
+@app.route("/job/<job_id>")
+def job_status(job_id):
+    try:
+        job = db_session.get(ProbeJob, uuid.UUID(job_id))
+    except ValueError:
+        job = None
+    if job is None:
+        return jsonify({"status":"error", "error":"No such job"}), 404
+    if job.state == "done":
+        return jsonify(json.loads(job.result))
+    if job.created < datetime.datetime.now() - datetime.timedelta(seconds=JOB_TIMEOUT):
+        return jsonify({"status":"error", "error":"Query timed out, please try again"})
+    return jsonify({"status":job.state, "job_id":str(job.id)})
 
 @app.route("/detail/<case_id>", methods=["GET", "POST"])
 def detail_page(case_id):
     uuid_case_id = uuid.UUID(case_id)
-    stmt = Select(Case).where(Case.id == uuid_case_id)
-    case = db_session.scalars(stmt).first()
+    stmt = Select(Case).where(Case.id == uuid_case_id).options(joinedload(Case.record_list))
+    case = db_session.scalars(stmt).unique().first()
     if case is None:
         return abort(404)
+    # the QR code is (re)generated while rendering, such pages are not cached
+    qr_code_ready = not case.expire_date or (case.qr_code_expire and case.qr_code_expire > datetime.datetime.now())
+    if request.method == "GET" and qr_code_ready and not session.get("_flashes"):
+        return cached_detail_page(case)
     if request.method == "POST":
         act = request.form.get("act",None)
         if act == "delete":
@@ -317,12 +859,7 @@ def detail_page(case_id):
             flash(f"Expire +{EXTENT_DAYS} days", category="success")
             case.renew()
         if act == "refresh" and case.passport_number is not None:
-            result = query_ceac_state_safe(case.location,case.case_no,case.passport_number, case.surname)
-            if isinstance(result,str):
-                return jsonify({"status":"error", "error":result})
-            else:
-                Case.updateRecord(case.case_no, result)
-                return jsonify({"status":"success", "title": result[0], "message": result[3]})
+            return submit_job("refresh", case.case_no, run_refresh, case.location, case.case_no, case.passport_number, case.surname)
         if act=="interview":
             interview_date = request.form.get("interview_date",None)
             if interview_date:
@@ -332,41 +869,220 @@ def detail_page(case_id):
                 case.interview_date = None
                 case.interview_week = None
         db_session.commit()
+    return render_detail(case)
+
+
+def render_detail(case: "Case"):
     if case.passport_number is None and case.last_status != "Issued":
         flash("Please register again and complete the passport number and surname. You don't need to delete this old case.", category="warning")
     return render_template("detail.html", case=case, record_list=case.record_list, location_str=LocationDict[case.location])
 
 
-#@app.route("/stat.js")
-def stat_result():
+class PageCache:
+    """Small LRU of rendered pages, keyed by case id and checked against the page ETag."""
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, etag):
+        with self.lock:
+            item = self.pages.get(key)
+            if item is None or item[0] != etag:
+                return None
+            self.pages.move_to_end(key)
+            return item[1]
+
+    def put(self, key, etag, page):
+        with self.lock:
+            self.pages[key] = (etag, page)
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.pages.pop(key, None)
+
+detail_cache = PageCache(int(os.environ.get("DETAIL_CACHE_SIZE") or 1024))
+
+# pages rendered from older templates must not match after a deploy
+_template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
+TEMPLATE_VERSION = hashlib.sha1(b"".join(open(os.path.join(_template_dir, name), "rb").read()
+    for name in ("base.html", "detail.html"))).hexdigest()[:8]
+
+def detail_etag(case: "Case"):
+    last = case.last_update
+    state = (TEMPLATE_VERSION, case.id, case.last_check, len(case.record_list), last and last.id,
+        case.location, case.expire_date, case.interview_date, case.push_channel, case.qr_code_url,
+        case.passport_number is None, case.surname is None, case.last_status)
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+def cached_detail_page(case: "Case"):
+    """GET of the detail page: 304 for repeat visitors, otherwise serve from or fill detail_cache."""
+    etag = detail_etag(case)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        page = detail_cache.get(case.id, etag)
+        if page is None:
+            page = render_detail(case)
+            detail_cache.put(case.id, etag, page)
+        response = make_response(page)
+    response.set_etag(etag)
+    if case.last_check:
+        response.last_modified = case.last_check
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def render_stat_js():
     this_week = datetime.datetime.now() - datetime.timedelta(days=datetime.datetime.now().isoweekday()-1)
     date_range = datetime.datetime.now() - datetime.timedelta(weeks=52)
     week_range = date_range.isocalendar()[0]*100 + date_range.isocalendar()[1]
-    stmt = Select(func.count(),Case.last_status, Case.interview_week) \
-        .group_by(Case.last_status, Case.interview_week) \
-        .filter(Case.interview_week != None) \
-        .filter(Case.interview_week >= week_range)
+    stmt = Select(StatCount.count, StatCount.status, StatCount.interview_week, StatCount.updated) \
+        .filter(StatCount.interview_week >= week_range, StatCount.count > 0)
     result = db_session.execute(stmt).all()
+    db_session.rollback()
     stat_json = defaultdict(dict)
-    labels = set()
-    for count, status, week in result:
+    update_time = None
+    for count, status, week, updated in result:
         week_str = datetime.date.fromisocalendar(week//100, week%100, 1).strftime("%m-%d")
         stat_json[status][week_str] = count
-        labels.add(week_str)
+        update_time = max(update_time or updated, updated)
     labels = [(this_week - datetime.timedelta(days=i*7)).strftime("%m-%d") for i in range(52)]
     stat_json = { k: [stat_json[k].get(l,0) for l in labels] for k in stat_json.keys()}
     stat_json["_labels_"] = labels
-    stat_json["_update_time_"]=datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + " UTC"
-    js_content = "var STAT_RESULT = " + json.dumps(stat_json) + ";"
-    
+    # time of the last change, so the content (and its digest) only changes with the data
+    stat_json["_update_time_"]=(update_time or datetime.datetime.now()).strftime("%Y-%m-%d %H:%M") + " UTC"
+    return "var STAT_RESULT = " + json.dumps(stat_json) + ";"
+
+
+def stat_result():
+    js_content = render_stat_js()
+    digest = hashlib.sha1(js_content.encode()).hexdigest()
+    snapshot = db_session.get(Snapshot, "stat.js")
+    if snapshot and snapshot.digest == digest:
+        return "not modified"
     # Put the js content into Tencent COS
     req = requests.put(COS_URL, data=js_content)
+    if req.status_code == 200:
+        Snapshot.save("stat.js", js_content, digest)
     return req.status_code
-        
-    # response = make_response("var STAT_RESULT = " + json.dumps(stat_json) + ";")
-    # response.headers['Cache-Control'] = 'public, max-age=3600'
-    # response.headers['Content-Type'] = 'application/javascript'
-    # return response
+
+
+STAT_JS_TTL = 60 # seconds the rendered stat.js is reused by this process
+_stat_js_cache = {}
+
+@app.route("/stat.js")
+def stat_js():
+    if _stat_js_cache.get("expires", 0) < time.time():
+        body = render_stat_js().encode()
+        _stat_js_cache.update(body=body, gzip=gzip.compress(body), etag=hashlib.sha1(body).hexdigest(),
+            expires=time.time() + STAT_JS_TTL)
+    use_gzip = "gzip" in request.accept_encodings
+    etag = _stat_js_cache["etag"] + ("-gz" if use_gzip else "")
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(_stat_js_cache["gzip"] if use_gzip else _stat_js_cache["body"])
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age=600"
+    response.headers["Content-Type"] = "application/javascript"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def update_analytics():
+    start = time.time()
+    history = analytics.load_history(db_session, Case, Record, StatusText)
+    Snapshot.save("analytics.json", json.dumps(analytics.compute(history)))
+    Snapshot.save("schedule.json", scheduler.fit(history).to_json())
+    _schedule_cache.clear()
+    print("Analytics updated in %.1fs" % (time.time() - start))
+
+@app.cli.command('analytics', help="Recompute processing-time analytics and the sync schedule")
+def analytics_command():
+    update_analytics()
+
+
+SCHEDULE_TTL = 3600 # seconds a process keeps the fitted schedule
+_schedule_cache = {}
+
+def current_schedule() -> scheduler.Schedule:
+    if _schedule_cache.get("expires", 0) < time.time():
+        snapshot = db_session.get(Snapshot, "schedule.json")
+        _schedule_cache.update(schedule=scheduler.Schedule.from_json(snapshot.content) if snapshot else scheduler.Schedule(),
+            expires=time.time() + SCHEDULE_TTL)
+    return _schedule_cache["schedule"]
+
+
+@app.route("/analytics.json")
+def analytics_json():
+    snapshot = db_session.get(Snapshot, "analytics.json")
+    if snapshot is None:
+        return abort(404)
+    response = make_response(snapshot.content)
+    response.set_etag(snapshot.digest)
+    response.last_modified = snapshot.updated
+    response.headers["Cache-Control"] = "public, max-age=600"
+    response.headers["Content-Type"] = "application/json"
+    return response.make_conditional(request)
+
+
+@app.cli.command('rebuild_stat', help="Recount the stat_count table from all cases")
+def rebuild_stat():
+    db_session.execute(delete(StatCount))
+    stmt = Select(Case.interview_week, Case.last_status, func.count()) \
+        .group_by(Case.interview_week, Case.last_status) \
+        .filter(Case.interview_week != None, Case.last_status != None)
+    rows = [{"interview_week": week, "status": status, "count": count} for week, status, count in db_session.execute(stmt)]
+    if rows:
+        db_session.execute(insert(StatCount), rows)
+    db_session.commit()
+    print("Rebuilt", len(rows), "stat rows")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else None
+
+
+@app.route("/admin/sync")
+def admin_sync():
+    pwd = request.args.get("pwd")
+    if pwd != os.environ.get("SECRET_KEY"):
+        return "Need Pwd"
+    runs = db_session.scalars(Select(SyncRun).order_by(SyncRun.id.desc()).limit(int(request.args.get("n") or 60))).all()
+    chunk_stats = defaultdict(list)
+    probes = defaultdict(lambda: {"chunks": 0, "failed": 0, "attempts": 0, "seconds": []})
+    if runs:
+        rows = db_session.execute(Select(SyncChunk.run_id, SyncChunk.probe, SyncChunk.seconds, SyncChunk.attempts, SyncChunk.ok)
+            .where(SyncChunk.run_id >= runs[-1].id)).all()
+        latest = max((row[0] for row in rows), default=None) # last run that queried anything
+        for run_id, probe, seconds, attempts, ok in rows:
+            chunk_stats[run_id].append(seconds)
+            if run_id == latest:
+                p = probes[probe]
+                p["chunks"] += 1
+                p["failed"] += 0 if ok else 1
+                p["attempts"] += attempts
+                p["seconds"].append(seconds)
+    trend = [{
+        "run": run,
+        "rate": run.queried / run.seconds * 60 if run.seconds > 0 else 0,
+        "p50": percentile(chunk_stats[run.id], 0.5),
+        "p95": percentile(chunk_stats[run.id], 0.95),
+    } for run in runs]
+    for p in probes.values():
+        p["p50"], p["p95"] = percentile(p["seconds"], 0.5), percentile(p["seconds"], 0.95)
+    db_session.rollback()
+    return render_template("admin_sync.html", trend=trend, probes=probes,
+        last_run=runs[0] if runs else None, SYNC_BUDGET=SYNC_BUDGET, token_stats=token_stats, query_cache_stats=query_cache.stats,
+        detail_cache_size=len(detail_cache.pages))
 
 
 @app.route('/endpoint', methods=["GET","POST"])
@@ -0,0 +1,180 @@
+"""Incremental reader for case dumps, used by `/import_case` and `flask import_cases`.
+
+A dump is a JSON array of cases, a JSON object of cases (keyed by anything)
+or newline-delimited JSON. Values are decoded one at a time with
+JSONDecoder.raw_decode from a small text buffer, so memory does not grow
+with the size of the upload."""
+import codecs
+import datetime
+import json
+import uuid
+from typing import IO, Iterable, Iterator, List
+
+WHITESPACE = " \t\r\n\ufeff" # and a UTF-8 BOM
+
+
+class DumpReader:
+    def __init__(self, fp: IO, chunk_size=1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.mark = None # keep the buffer from here on while looking ahead
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.fp.read(self.chunk_size)
+        while isinstance(data, bytes):
+            raw = data
+            data = self.utf8.decode(raw, final=not raw)
+            if raw and not data: # only part of a multi-byte character
+                data = self.fp.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return False
+        keep = self.pos if self.mark is None else self.mark
+        self.buf = self.buf[keep:] + data
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark -= keep
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, "" at the end of the input."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch not in chars or not ch:
+            raise ValueError("Expected %r at offset %d, got %r" % (chars, self.pos, ch))
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                self.pos = end
+                return obj
+            except json.JSONDecodeError:
+                if not self.fill(): # a value cut off at the buffer end parses once more input is read
+                    raise
+
+    def line_object(self, limit=1 << 20):
+        """Whether the input is NDJSON: the line at pos holds a whole object
+        and the next line starts with another one, or it is a single case.
+        Looks at most `limit` characters ahead."""
+        while "\n" not in self.buf[self.pos:self.pos + limit] and len(self.buf) - self.pos < limit:
+            if not self.fill():
+                break
+        end = self.buf.find("\n", self.pos, self.pos + limit)
+        if end < 0:
+            if not self.eof:
+                return False
+            end = len(self.buf)
+        try:
+            obj, obj_end = self.decoder.raw_decode(self.buf[:end], self.pos)
+        except json.JSONDecodeError:
+            return False
+        if not isinstance(obj, dict) or self.buf[obj_end:end].strip(WHITESPACE):
+            return False
+        self.pos = end
+        ch = self.peek()
+        return ch == "{" or not ch and not all(isinstance(v, dict) for v in obj.values())
+
+    def __iter__(self) -> Iterator[dict]:
+        ch = self.peek()
+        if ch == "[":
+            self.pos += 1
+            if self.peek() == "]":
+                return
+            while True:
+                yield self.value()
+                if self.expect(",]") == "]":
+                    return
+        if ch != "{":
+            if ch:
+                raise ValueError("Expected a JSON array, object or lines of objects, got %r" % ch)
+            return
+        # {"<key>": {case}, ...} or the first line of NDJSON
+        self.mark = self.pos
+        keyed = not self.line_object()
+        if keyed:
+            self.pos = self.mark + 1
+            ch = self.peek()
+            if ch == "}": # {}
+                return
+            keyed = ch == '"'
+            if keyed:
+                self.value()
+                keyed = self.expect(":") and self.peek() == "{"
+            if keyed:
+                self.value() # the first case has to be followed by the next key or the end
+                keyed = self.peek() in ",}"
+        self.pos, self.mark = self.mark, None
+        if not keyed:
+            while self.peek():
+                yield self.value()
+            return
+        self.pos += 1
+        if self.peek() == "}":
+            return
+        while True:
+            self.value()
+            self.expect(":")
+            yield self.value()
+            if self.expect(",}") == "}":
+                return
+
+
+def batched(items: Iterable, size) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def case_rows(c: dict, extent_days, today=None):
+    """Insert values of an exported case and its records."""
+    today = today or datetime.date.today()
+    records = [{
+        "status_date": datetime.date.fromisoformat(r["status_date"]),
+        "status": r["status"],
+        "message": r["message"],
+    } for r in c.get("record_list") or []]
+    last_status = c.get("last_status")
+    if last_status is None and records:
+        last_status = max(records, key=lambda r: r["status_date"])["status"]
+    interview_date = datetime.date.fromisoformat(c["interview_date"]) if c.get("interview_date") else None
+    case = {
+        "id": uuid.uuid4(),
+        "case_no": c["case_no"],
+        "location": c["location"],
+        "created_date": datetime.date.fromisoformat(c["created_date"]),
+        "passport_number": c.get("passport_number"),
+        "surname": c.get("surname"),
+        "last_check": datetime.datetime.fromisoformat(c["last_check"]) if c.get("last_check") else None,
+        "last_status": last_status,
+        "push_channel": c.get("push_channel"),
+        "interview_date": interview_date,
+        "interview_week": interview_date.isocalendar()[0] * 100 + interview_date.isocalendar()[1] if interview_date else None,
+        "expire_date": today + datetime.timedelta(days=extent_days) if last_status != "Issued" else None,
+    }
+    for r in records:
+        r["case_id"] = case["id"]
+    return case, records
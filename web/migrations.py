@@ -0,0 +1,162 @@
+"""Versioned schema migrations, applied in order by `flask migrate`.
+
+Each migration runs in its own transaction and is recorded in the
+schema_version table. Migrations must be safe on a database created by
+`create_all` from the current models, where most of them are no-ops."""
+import datetime
+import hashlib
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, delete, func, insert, inspect, literal, select, text, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateColumn
+
+version_table = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200)),
+    Column("applied", DateTime),
+)
+
+MIGRATIONS = []
+
+def migration(version, description):
+    def wrap(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return wrap
+
+
+def create_index(conn: Connection, metadata: MetaData, table, name):
+    index = next((i for i in metadata.tables[table].indexes if i.name == name), None)
+    if index is None: # no longer in the models, dropped by a later migration
+        return
+    if name not in {i["name"] for i in inspect(conn).get_indexes(table)}:
+        index.create(conn)
+
+
+def drop_index(conn: Connection, metadata: MetaData, table, name):
+    reflected = Table(table, MetaData(), autoload_with=conn)
+    for index in reflected.indexes:
+        if index.name == name:
+            index.drop(conn)
+
+
+def add_column(conn: Connection, metadata: MetaData, table, name):
+    if name in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return
+    column = metadata.tables[table].c[name]
+    preparer = conn.dialect.identifier_preparer
+    conn.execute(text("ALTER TABLE %s ADD COLUMN %s" % (
+        preparer.format_table(metadata.tables[table]), CreateColumn(column).compile(dialect=conn.dialect))))
+
+
+@migration(1, "create missing tables")
+def create_tables(conn, metadata):
+    metadata.create_all(conn, checkfirst=True)
+
+
+@migration(2, "backfill stat_count")
+def backfill_stat_count(conn, metadata):
+    case, stat = metadata.tables["case"], metadata.tables["stat_count"]
+    conn.execute(delete(stat))
+    conn.execute(insert(stat).from_select(["interview_week", "status", "count", "updated"],
+        select(case.c.interview_week, case.c.last_status, func.count(), literal(datetime.datetime.now()))
+            .where(case.c.interview_week != None, case.c.last_status != None)
+            .group_by(case.c.interview_week, case.c.last_status)))
+
+
+@migration(3, "index record(case_id, status_date)")
+def index_record_case(conn, metadata):
+    create_index(conn, metadata, "record", "ix_record_case_id_status_date")
+
+
+@migration(4, "index for the sync selection")
+def index_case_sync(conn, metadata):
+    create_index(conn, metadata, "case", "ix_case_sync")
+
+
+@migration(5, "case.next_check_at for the adaptive sync schedule")
+def add_next_check_at(conn, metadata):
+    case = metadata.tables["case"]
+    add_column(conn, metadata, "case", "next_check_at")
+    # due right away, oldest check first, until the first sync reschedules each case
+    conn.execute(update(case).where(case.c.next_check_at == None)
+        .values(next_check_at=func.coalesce(case.c.last_check, literal(datetime.datetime.now()))))
+    create_index(conn, metadata, "case", "ix_case_due")
+    drop_index(conn, metadata, "case", "ix_case_sync")
+
+
+@migration(6, "sync_run and sync_chunk telemetry")
+def create_sync_tables(conn, metadata):
+    metadata.tables["sync_run"].create(conn, checkfirst=True)
+    metadata.tables["sync_chunk"].create(conn, checkfirst=True)
+
+
+@migration(7, "probe_job for background register and refresh queries")
+def create_probe_job(conn, metadata):
+    metadata.tables["probe_job"].create(conn, checkfirst=True)
+
+
+@migration(8, "record status and message as status_text ids")
+def intern_record_texts(conn, metadata):
+    metadata.tables["status_text"].create(conn, checkfirst=True)
+    if "status" not in {c["name"] for c in inspect(conn).get_columns("record")}:
+        return # created by create_all with the new columns
+    status_text, record = metadata.tables["status_text"], metadata.tables["record"]
+    old = Table("record", MetaData(), autoload_with=conn)
+    known = {digest for digest, in conn.execute(select(status_text.c.digest))}
+    texts = {t for t, in conn.execute(select(old.c.status).union(select(old.c.message)))}
+    rows = [{"text": t, "digest": hashlib.sha1(t.encode()).hexdigest()} for t in texts]
+    rows = [r for r in rows if r["digest"] not in known]
+    if rows:
+        conn.execute(insert(status_text), rows)
+    # copy into a new table and swap, instead of adding and dropping columns
+    # in place, so the table is written compactly once on every backend
+    scratch = MetaData()
+    for name in ("case", "status_text"): # foreign key targets
+        metadata.tables[name].to_metadata(scratch)
+    new = record.to_metadata(scratch, name="record_new")
+    new.indexes.clear()
+    new.create(conn)
+    status, message = status_text.alias("status"), status_text.alias("message")
+    conn.execute(insert(new).from_select(["id", "case_id", "status_date", "status_id", "message_id"],
+        select(old.c.id, old.c.case_id, old.c.status_date, status.c.id, message.c.id)
+            .join(status, status.c.text == old.c.status).join(message, message.c.text == old.c.message)))
+    old.drop(conn)
+    conn.execute(text("ALTER TABLE record_new RENAME TO record"))
+    for index in record.indexes:
+        create_index(conn, metadata, "record", index.name)
+    if conn.dialect.name == "postgresql": # ids were copied, move the sequence past them
+        conn.execute(text("SELECT setval(pg_get_serial_sequence('record', 'id'), coalesce(max(id), 1)) FROM record"))
+
+
+@migration(9, "reset case.last_status left as a date by the old sync")
+def fix_last_status(conn, metadata):
+    case, record, status_text = metadata.tables["case"], metadata.tables["record"], metadata.tables["status_text"]
+    latest = select(status_text.c.text) \
+        .select_from(record.join(status_text, status_text.c.id == record.c.status_id)) \
+        .where(record.c.case_id == case.c.id) \
+        .order_by(record.c.status_date.desc(), record.c.id.desc()).limit(1).scalar_subquery()
+    # every status ever seen is in status_text, anything else is a stored date
+    conn.execute(update(case).where(case.c.last_status != None, case.c.last_status.not_in(select(status_text.c.text)))
+        .values(last_status=latest))
+    backfill_stat_count(conn, metadata) # migration 2 counted the dates as statuses
+
+
+def current_version(conn: Connection):
+    return conn.execute(select(version_table.c.version).order_by(version_table.c.version.desc()).limit(1)).scalar() or 0
+
+
+def upgrade(engine: Engine, metadata: MetaData, target=None, log=print):
+    version_table.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        version = current_version(conn)
+    for number, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if number <= version or (target is not None and number > target):
+            continue
+        log("Migrating to %d: %s" % (number, description))
+        with engine.begin() as conn:
+            fn(conn, metadata)
+            conn.execute(insert(version_table).values(version=number, description=description, applied=datetime.datetime.now()))
+        version = number
+    return version
@@ -0,0 +1,89 @@
+"""Adaptive sync schedule: how long until a case is worth checking again.
+
+Rates are fitted on the Record history loaded by analytics.load_history.
+Every record opens a spell in its status that ends with the next record of
+the case (a detected change) or, for the latest record, is still running at
+the case's last check. For every status and weekly age bucket the rate is
+changes per case-day spent at that age, shrunk towards the status-wide rate
+where the history is thin. A case is due again when the chance that it has
+changed reaches SCHEDULE_CHANGE_PER_CHECK, within the hour bounds below."""
+import datetime
+import json
+import math
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .analytics import History
+
+SCHEDULE_MIN_HOURS = float(os.environ.get("SCHEDULE_MIN_HOURS") or 6)
+SCHEDULE_MAX_HOURS = float(os.environ.get("SCHEDULE_MAX_HOURS") or 168)
+SCHEDULE_CHANGE_PER_CHECK = float(os.environ.get("SCHEDULE_CHANGE_PER_CHECK") or 0.02)
+AGE_BIN_DAYS = 7
+AGE_BINS = 26 # the last bucket also holds everything older
+PRIOR_DAYS = 30 # case-days of the status-wide rate mixed into every bucket
+
+
+class Schedule:
+    def __init__(self, rates: Dict[str, List[float]] = None, default_rate: Optional[float] = None):
+        self.rates = rates or {}
+        self.default_rate = default_rate # changes per day, None when nothing was fitted
+
+    def rate(self, status, age_days):
+        bins = self.rates.get(status)
+        if bins is None or age_days is None:
+            return self.default_rate
+        return bins[min(max(age_days, 0) // AGE_BIN_DAYS, AGE_BINS - 1)]
+
+    def interval(self, status, age_days) -> datetime.timedelta:
+        """Time until the next check of a case `age_days` after its last status change."""
+        rate = self.rate(status, age_days)
+        if not rate:
+            hours = SCHEDULE_MIN_HOURS if rate is None else SCHEDULE_MAX_HOURS
+        else:
+            hours = -math.log(1 - SCHEDULE_CHANGE_PER_CHECK) / rate * 24
+        return datetime.timedelta(hours=min(max(hours, SCHEDULE_MIN_HOURS), SCHEDULE_MAX_HOURS))
+
+    def to_json(self):
+        return json.dumps({"bin_days": AGE_BIN_DAYS, "default": self.default_rate, "rates": self.rates})
+
+    @staticmethod
+    def from_json(content):
+        data = json.loads(content)
+        if data.get("bin_days") != AGE_BIN_DAYS:
+            return Schedule()
+        return Schedule(data["rates"], data["default"])
+
+
+def fit(h: History) -> Schedule:
+    same = h.case[1:] == h.case[:-1]
+    completed = np.flatnonzero(same) # records followed by another record of the case
+    last = np.flatnonzero(np.append(~same, True)) if len(h.case) else np.zeros(0, dtype=np.int64)
+    end = h.last_check_day[h.case[last]]
+    running = last[end >= h.day[last]]
+    spell = np.concatenate([completed, running])
+    days = np.concatenate([h.day[completed + 1] - h.day[completed], h.last_check_day[h.case[running]] - h.day[running]])
+    changed = np.concatenate([np.ones(len(completed)), np.zeros(len(running))])
+    if len(spell) == 0:
+        return Schedule()
+
+    n_status = len(h.status_codes)
+    bins = np.minimum(days // AGE_BIN_DAYS, AGE_BINS - 1)
+    key = h.status[spell] * AGE_BINS + bins
+    size = n_status * AGE_BINS
+    events = np.bincount(key, weights=changed, minlength=size).reshape(n_status, AGE_BINS)
+    ending = np.bincount(key, minlength=size).reshape(n_status, AGE_BINS)
+    partial = np.bincount(key, weights=days - bins * AGE_BIN_DAYS, minlength=size).reshape(n_status, AGE_BINS)
+    # a spell that ends in a later bucket spends the whole of this one at risk
+    later = np.cumsum(ending[:, ::-1], axis=1)[:, ::-1] - ending
+    exposure = partial + later * AGE_BIN_DAYS
+
+    if events.sum() == 0:
+        return Schedule()
+    default_rate = events.sum() / max(exposure.sum(), 1.0)
+    status_events, status_exposure = events.sum(axis=1), exposure.sum(axis=1)
+    status_rate = np.where(status_exposure > 0, status_events / np.maximum(status_exposure, 1.0), default_rate)
+    rates = (events + PRIOR_DAYS * status_rate[:, None]) / (exposure + PRIOR_DAYS)
+    return Schedule({status: np.round(rates[code], 6).tolist() for status, code in h.status_codes.items()},
+                    round(float(default_rate), 6))
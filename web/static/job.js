@@ -0,0 +1,13 @@
+// /register and refresh answer with a job id, poll /job/<id> until the query is done
+async function waitJob(data, interval = 1000) {
+  while (data.status == "queued" || data.status == "running") {
+    await new Promise(resolve => setTimeout(resolve, interval));
+    try {
+      const resp = await fetch("/job/" + data.job_id);
+      data = await resp.json();
+    } catch (e) {
+      return {status: "error", error: "Network error, please try again"};
+    }
+  }
+  return data;
+}
@@ -0,0 +1,200 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeEndpoint:
+    def __init__(self, url, concurrency):
+        self.url = url
+        self.concurrency = concurrency
+        self.inflight = 0
+        self.health = 1.0  # EWMA of chunk success, 1 = every recent chunk succeeded
+        self.latency = None  # EWMA of seconds per chunk
+        self.down_until = 0.0  # monotonic time the endpoint cools down until
+
+    @property
+    def weight(self):
+        return self.health * (self.concurrency - self.inflight) / self.concurrency
+
+
+class ProbeDispatcher:
+    """Spread chunks over several probes, each with its own concurrency limit.
+    A chunk goes to the endpoint with the most free, healthy capacity and is
+    retried on another endpoint when a probe fails. An endpoint whose health
+    drops below `min_health` gets no chunks for `cooldown` seconds."""
+
+    def __init__(self, urls: List[str], concurrency=2, timeout=1800, retries=3,
+                 min_health=0.7, cooldown=30, retry_delay=2):
+        self.endpoints = [ProbeEndpoint(url, concurrency) for url in urls]
+        self.timeout = timeout
+        self.retries = retries
+        self.min_health = min_health
+        self.cooldown = cooldown
+        self.retry_delay = retry_delay
+        self.cond = threading.Condition()
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.capacity)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    @property
+    def capacity(self):
+        return sum(e.concurrency for e in self.endpoints)
+
+    def acquire(self, avoid=()) -> ProbeEndpoint:
+        """A free endpoint, waiting for one not in `avoid` to free up. Endpoints
+        in `avoid` are only used again once every endpoint up has been tried."""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                up = [e for e in self.endpoints if e.down_until <= now] or self.endpoints
+                candidates = [e for e in up if e not in avoid] or up
+                free = [e for e in candidates if e.inflight < e.concurrency]
+                if free:
+                    endpoint = max(free, key=lambda e: e.weight)
+                    endpoint.inflight += 1
+                    return endpoint
+                self.cond.wait(timeout=1) # cooldowns end without a notify
+
+    def release(self, endpoint: ProbeEndpoint, ok, elapsed):
+        with self.cond:
+            endpoint.inflight -= 1
+            endpoint.health = 0.8 * endpoint.health + 0.2 * (1.0 if ok else 0.0)
+            if not ok and endpoint.health < self.min_health:
+                endpoint.down_until = time.monotonic() + self.cooldown
+                logger.warning("Probe %s cooling down for %ss, health %.2f", endpoint.url, self.cooldown, endpoint.health)
+            if ok:
+                endpoint.latency = elapsed if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * elapsed
+            self.cond.notify_all()
+
+    def query(self, chunk, report=None) -> dict:
+        """Results of one chunk, {} when every attempt failed. `report`, if
+        given, receives the probe that answered, attempts and seconds."""
+        tried = []
+        report = {} if report is None else report
+        report.update(probe=None, attempts=0, seconds=0.0, ok=False)
+        for attempt in range(self.retries):
+            endpoint = self.acquire(avoid=tried)
+            if endpoint in tried: # nothing else left, give it a moment
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            start = time.monotonic()
+            ok = False
+            report["attempts"] += 1
+            report["probe"] = endpoint.url
+            try:
+                resp = self.http.post(endpoint.url, json=chunk, timeout=self.timeout)
+                resp.raise_for_status()
+                ret = resp.json()
+                ok = report["ok"] = True
+                return ret
+            except Exception as e:
+                logger.warning("Probe %s failed: %s", endpoint.url, e)
+                tried.append(endpoint)
+            finally:
+                elapsed = time.monotonic() - start
+                report["seconds"] += elapsed
+                self.release(endpoint, ok, elapsed)
+        logger.error("Giving up chunk %s", [case[1] for case in chunk])
+        return {}
+
+
+def run_pipeline(chunks: Iterable[list], dispatcher: ProbeDispatcher, apply: Callable[[list, dict, dict], None], depth=4):
+    """Read -> dispatch -> write, joined by bounded queues.
+
+    `chunks` is consumed in a reader thread, chunks are sent to the probes from
+    a pool sized to the dispatcher's capacity, and `apply(chunk, result, report)`
+    runs in the calling thread so all writes stay on one DB session."""
+    todo = queue.Queue(maxsize=depth)
+    done = queue.Queue(maxsize=depth)
+    inflight = threading.BoundedSemaphore(dispatcher.capacity)
+    errors = []
+
+    def read():
+        try:
+            for chunk in chunks:
+                todo.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            todo.put(None)
+
+    def work(chunk):
+        try:
+            report = {}
+            result = dispatcher.query(chunk, report)
+            done.put((chunk, result, report))
+        finally:
+            inflight.release()
+
+    def dispatch():
+        with ThreadPoolExecutor(max_workers=dispatcher.capacity, thread_name_prefix="dispatch") as pool:
+            while (chunk := todo.get()) is not None:
+                inflight.acquire()
+                pool.submit(work, chunk)
+        done.put(None)
+
+    threading.Thread(target=read, name="sync-reader", daemon=True).start()
+    threading.Thread(target=dispatch, name="sync-dispatcher", daemon=True).start()
+    while (item := done.get()) is not None:
+        apply(*item)
+    if errors:
+        raise errors[0]
+
+
+class QueryCache:
+    """Single-flight calls with a short-TTL cache of their results, for the
+    one-case queries of /register and refresh. Callers with the same key
+    while a call is running wait for it instead of querying the probe again,
+    and successful results are reused for `ttl` seconds. Per process."""
+
+    def __init__(self, ttl, size=1024):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (checked_at, result)
+        self.inflight = {}  # key -> Future of (checked_at, result)
+        self.stats = {"hit": 0, "coalesced": 0, "miss": 0}
+
+    def get(self, key, fn: Callable, cacheable: Callable = lambda result: True):
+        """(checked_at, fn()), where checked_at is when the shared call finished."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0].timestamp() < self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["hit"] += 1
+                return entry
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+                self.stats["miss"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            return future.result()
+        try:
+            entry = (datetime.datetime.now(), fn())
+        except BaseException as e:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.inflight[key]
+            if self.ttl > 0 and cacheable(entry[1]):
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        future.set_result(entry)
+        return entry
@@ -1,5 +1,10 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+import fcntl
+import json
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from xml.etree import ElementTree
 import os
 import yaml
@@ -10,6 +15,42 @@ appID, appSecret, serverToken, tempID = os.environ.get("WX_CONFIG").split("|")
 # if we need a proxy in ip white list to get access token
 WXAPI_URL = os.environ.get("WXAPI_URL") or "https://api.weixin.qq.com/cgi-bin/stable_token"
 
+# pooled connections for api.weixin.qq.com, shared by the push worker threads
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_maxsize=16))
+
+
+class WechatError(Exception):
+    # invalid openid, user unsubscribed / refused template messages
+    PERMANENT = {40003, 43004, 43101}
+
+    def __init__(self, errcode, errmsg):
+        super().__init__("%s: %s" % (errcode, errmsg))
+        self.errcode = errcode
+
+
+class RateLimiter:
+    """Token bucket shared between threads, `wait` blocks until a token is free."""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
 def check_wx_signature(signature, timestamp, nonce, token = serverToken):
     if not signature or not timestamp or not nonce or not token:
         return False
@@ -27,18 +68,70 @@ def xmltodict(xml_string):
     ret = [(child.tag, child.text) for child in root]
     return dict(ret)
 
+WX_TOKEN_CACHE = os.environ.get("WX_TOKEN_CACHE") or "/tmp/wx_access_token.json"
+WX_TOKEN_REFRESH_AHEAD = int(os.environ.get("WX_TOKEN_REFRESH_AHEAD") or 300) # seconds before expiry
+
+# access token shared by all workers through WX_TOKEN_CACHE, the in-process copy avoids reading the file
 access_token = None
-expires_in = None
-def get_access_token():
-    global access_token, expires_in
-    if access_token and expires_in < datetime.now():
-        return access_token
-    ret = requests.post(WXAPI_URL, json={"grant_type": "client_credential", "appid": appID, "secret":  appSecret}).json()
-    if "errcode" in ret:
-        raise Exception(ret["errmsg"])
-    access_token = ret["access_token"]
-    expires_in = datetime.now() + timedelta(seconds=ret["expires_in"])
-    return ret["access_token"]
+token_stats = {"hit": 0, "refresh": 0}
+_token_lock = threading.Lock()
+
+def _token_fresh(token):
+    if token is None:
+        return False
+    now = time.time()
+    # stable_token keeps returning the old token until it is rotated,
+    # so do not hammer it while the rotation is pending
+    return token["expires_at"] - WX_TOKEN_REFRESH_AHEAD > now or now - token["fetched_at"] < 60
+
+def _read_token_file():
+    try:
+        with open(WX_TOKEN_CACHE) as f:
+            token = json.load(f)
+        return token if token["expires_at"] > time.time() else None
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _write_token_file(token):
+    tmp = "%s.%d" % (WX_TOKEN_CACHE, os.getpid())
+    # readable by this user only, and never through a file planted at tmp
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError: # left over by a crashed process with the same pid
+        os.unlink(tmp)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(token, f)
+    os.replace(tmp, WX_TOKEN_CACHE)
+
+def get_access_token(stale=None):
+    """Shared access token. `stale` is a token WeChat rejected: it is not
+    returned again, and unless another worker has already replaced it a new
+    one is force-fetched."""
+    global access_token
+    if _token_fresh(access_token) and access_token["access_token"] != stale:
+        token_stats["hit"] += 1
+        return access_token["access_token"]
+    with _token_lock, open(WX_TOKEN_CACHE + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX) # one refresh across processes
+        access_token = None
+        token = _read_token_file()
+        if _token_fresh(token) and token["access_token"] != stale:
+            token_stats["hit"] += 1
+        else:
+            if token is not None and token["access_token"] == stale:
+                os.unlink(WX_TOKEN_CACHE)
+            # stable_token hands out the cached token again unless forced
+            ret = http.post(WXAPI_URL, json={"grant_type": "client_credential", "appid": appID, "secret":  appSecret,
+                "force_refresh": stale is not None}, timeout=10).json()
+            if "errcode" in ret:
+                raise Exception(ret["errmsg"])
+            now = time.time()
+            token = {"access_token": ret["access_token"], "expires_at": now + ret["expires_in"], "fetched_at": now}
+            _write_token_file(token)
+            token_stats["refresh"] += 1
+        access_token = token
+    return token["access_token"]
 
 '''
 ArFK9lrJ57rW4t4QQ6bqtdt8IFsLFZkLlPfrHI5hlCo
@@ -49,20 +142,33 @@ ArFK9lrJ57rW4t4QQ6bqtdt8IFsLFZkLlPfrHI5hlCo
 {{remark.DATA}}
 '''
 
+TOKEN_ERRCODES = (40001, 40014, 42001) # invalid, malformed, expired access token
+
+def post_with_token(url, post_json):
+    """POST to `url`, whose {ACCESS_TOKEN} is filled in, again with a new
+    token if WeChat rejects the current one."""
+    token = get_access_token()
+    ret = http.post(url=url.format(ACCESS_TOKEN=token), json=post_json, timeout=10).json()
+    if ret.get("errcode") in TOKEN_ERRCODES:
+        token = get_access_token(stale=token)
+        ret = http.post(url=url.format(ACCESS_TOKEN=token), json=post_json, timeout=10).json()
+    return ret
+
 def wechat_push_msg(touser, tempID=tempID, msg_url="", **kwargs):
-    url = "https://api.weixin.qq.com/cgi-bin/message/template/send?access_token={ACCESS_TOKEN}".format(
-        ACCESS_TOKEN=get_access_token())
+    url = "https://api.weixin.qq.com/cgi-bin/message/template/send?access_token={ACCESS_TOKEN}"
     data = {}
     for k,v in kwargs.items():
         data[k] = {"value": v}
     post_json = {"touser": touser, "template_id": tempID, "data": data, "url": msg_url}
-    requests.post(url=url, json=post_json)
+    ret = post_with_token(url, post_json)
+    if ret.get("errcode"):
+        raise WechatError(ret["errcode"], ret.get("errmsg"))
+    return ret
 
 def wechat_get_qr_code_url(scene_str):
-    url = " https://api.weixin.qq.com/cgi-bin/qrcode/create?access_token={ACCESS_TOKEN}".format(
-        ACCESS_TOKEN=get_access_token())
+    url = " https://api.weixin.qq.com/cgi-bin/qrcode/create?access_token={ACCESS_TOKEN}"
     post_json = {"expire_seconds": 2592000, "action_name": "QR_STR_SCENE", "action_info": {"scene": {"scene_str": scene_str}} }
-    ret = requests.post(url=url, json=post_json).json()
+    ret = post_with_token(url, post_json)
     if "errcode" in ret:
         raise RuntimeError(ret["errmsg"])
     return ret["url"]